@@ -5,7 +5,7 @@ from src.consumer import RabbitMQConsumer
 consumer = RabbitMQConsumer()
 
 if __name__ == "__main__":
-    app.logger.info("Server started running at {}:{}".format(config.HOST, config.PORT))
+    app.logger.info("Server started running at %s:%s", config.HOST, config.PORT)
     
     with app.app_context():
         try:
@@ -19,5 +19,5 @@ if __name__ == "__main__":
         except Exception as e:
             app.logger.error(str(e))
         finally:
-            app.logger.info("Server terminated at {}:{}".format(config.HOST, config.PORT))
+            app.logger.info("Server terminated at %s:%s", config.HOST, config.PORT)
             consumer.stop()
@@ -0,0 +1,15 @@
+import multiprocessing
+import os
+
+# same variables as src/config, read directly so loading this file does not import the app
+env = "PROD" if os.environ.get("PYTHON_ENV") == "production" else "DEV"
+
+bind = "{}:{}".format(os.environ.get(f"{env}_HOST", "0.0.0.0"), os.environ.get(f"{env}_PORT", 5000))
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("WEB_THREADS", 1))
+timeout = int(os.environ.get("WEB_TIMEOUT", 30))
+
+# The app is imported once in the master and shared copy-on-write. Nothing connects
+# at import, every worker opens its own Redis, Elasticsearch and RabbitMQ connections
+preload_app = True
+accesslog = "-"
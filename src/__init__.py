@@ -1,11 +1,23 @@
+import time
+
+# cold start timings of this process, reported by /healthz
+startup = {"started": time.perf_counter(), "startup_ms": None, "warmup_ms": None, "first_request_ms": None}
+
 from flask import Flask
 from flask_cors import CORS
 import os
 from src.config.config import Config
 from src.config.log_formatter import LogFormatter
+from src.config.log_filters import RateLimitFilter
 from dotenv import load_dotenv
 import logging
+import queue
+import atexit
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from flask.logging import default_handler
 from redis import Redis
+from redis.cluster import RedisCluster
 from flask_swagger_ui import get_swaggerui_blueprint
 
 # Logger
@@ -36,21 +48,56 @@ handler = logging.FileHandler(logger_path + "/logfile.log")  # Log to a file
 formatter = logging.Formatter('{"timestamp":"%(asctime)s", "level":"%(levelname)s", "logger":"%(module)s", "message":"%(message)s"}')
 handler.setFormatter(formatter)
 handler.format = LogFormatter.custom_formatter
-app.logger.addHandler(handler)
+
+# Request and consumer threads only enqueue records, the listener thread does
+# the JSON formatting and the file/console writes
+log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+queue_handler.addFilter(RateLimitFilter(config.LOG_DEBUG_RATE, config.LOG_DEBUG_BURST))
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(queue_handler)
+def start_log_listener():
+    global log_listener
+    log_listener = QueueListener(log_queue, handler, default_handler, respect_handler_level=True)
+    log_listener.start()
+
+def restart_log_listener():
+    # threads do not survive a fork, every worker process needs its own listener
+    global log_queue
+    log_queue = queue.SimpleQueue()
+    queue_handler.queue = log_queue
+    start_log_listener()
+
+start_log_listener()
+os.register_at_fork(after_in_child=restart_log_listener)
+atexit.register(lambda: log_listener.stop())
+
+def create_redis_client():
+    # the cluster client discovers the other nodes from the configured one
+    def connect():
+        if config.REDIS_CLUSTER:
+            return RedisCluster(host=config.REDIS_HOST, port=int(config.REDIS_PORT))
+        return Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0)
+    return LazyRedis(connect, cluster=bool(config.REDIS_CLUSTER))
 
 # import plans model
+from src.models.redis_model import LazyRedis
 from src.models.plans_model import PlanModel
 from src.models.elastic_search_model import ElasticSearchConfig
-redis_client_plan = Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0)
+redis_client_plan = create_redis_client()
 es_config = ElasticSearchConfig()
 plan_model = PlanModel(redis_client_plan, es_config)
 logger.info("Created plan model")
 
 from src.models.etag_model import EtagModel
-redis_client_etag = Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0)
+redis_client_etag = create_redis_client()
 etag_model = EtagModel(redis_client_etag)
 logger.info("Created etag model")
 
+# Redis, Elasticsearch and RabbitMQ connect on first use in each process
+from src.models.queue_model import QueueModel
+queue_model = QueueModel(os.getenv('RABBITMQ_HOST', 'localhost'), redis_client=redis_client_plan, stats_ttl=config.QUEUE_STATS_TTL)
+
 # import api blueprint to register it with app
 from src.routes import api
 app.register_blueprint(api, url_prefix = "/")
@@ -67,3 +114,33 @@ swagger_ui_blueprint = get_swaggerui_blueprint(
     }
 )
 app.register_blueprint(swagger_ui_blueprint, url_prefix=SWAGGER_URL)
+
+def warmup():
+    # Initialises the lazy dependencies off the request path, failures are
+    # left to the first request and to the readiness probe
+    started = time.perf_counter()
+    for name, step in (
+        ("schema", lambda: plan_model.plan_schema and plan_model.search_fields),
+        ("redis", redis_client_plan.ping),
+        ("elasticsearch", lambda: es_config.ensure_index(force=True))
+    ):
+        try:
+            step()
+        except Exception as e:
+            logger.warning("Warmup of %s failed -> %s", name, e)
+    startup["warmup_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info("Warmup completed in %s ms", startup["warmup_ms"])
+
+def start_warmup():
+    if config.WARMUP:
+        threading.Thread(target=warmup, name="warmup", daemon=True).start()
+
+def reset_startup():
+    # a forked worker starts its own timings and warmup
+    startup.update(started=time.perf_counter(), warmup_ms=None, first_request_ms=None)
+    start_warmup()
+
+startup["startup_ms"] = round((time.perf_counter() - startup["started"]) * 1000, 1)
+logger.info("Application initialised in %s ms", startup["startup_ms"])
+start_warmup()
+os.register_at_fork(after_in_child=reset_startup)
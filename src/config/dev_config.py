@@ -12,10 +12,26 @@ class DevConfig:
         self.PORT = os.environ.get('DEV_PORT')
         self.HOST = os.environ.get('DEV_HOST')
         self.LOG_LEVEL = logging.DEBUG
+        self.LOG_DEBUG_RATE = float(os.environ.get('DEV_LOG_DEBUG_RATE', 50))
+        self.LOG_DEBUG_BURST = float(os.environ.get('DEV_LOG_DEBUG_BURST', 100))
         self.REDIS_HOST = os.environ.get('REDIS_DEV_HOST')
         self.REDIS_PORT = os.environ.get('REDIS_DEV_PORT')
+        self.REDIS_CLUSTER = os.environ.get('REDIS_DEV_CLUSTER', 'false').lower() == 'true'
         self.RABBITMQ_HOST = os.environ.get('RABBITMQ_DEV_HOST')
         self.RABBITMQ_PORT = os.environ.get('RABBITMQ_DEV_PORT')
         self.VERSION = os.environ.get('DEV_VERSION')
         self.OAUTH_CLIENT_ID = os.environ.get('DEV_OAUTH_CLIENT_ID')
         self.ELASTIC_HOST = os.environ.get('DEV_ELASTIC_HOST')
+        self.ELASTIC_INDEX_VERSION = int(os.environ.get('DEV_ELASTIC_INDEX_VERSION', 1))
+        self.SINGLE_FLIGHT_REDIS = os.environ.get('DEV_SINGLE_FLIGHT_REDIS', 'false').lower() == 'true'
+        self.SINGLE_FLIGHT_LOCK_MS = int(os.environ.get('DEV_SINGLE_FLIGHT_LOCK_MS', 2000))
+        self.COMPRESSION_MIN_SIZE = int(os.environ.get('DEV_COMPRESSION_MIN_SIZE', 1024))
+        self.COMPRESSION_CACHE_BYTES = int(os.environ.get('DEV_COMPRESSION_CACHE_BYTES', 32 * 1024 * 1024))
+        self.MGET_MAX_IDS = int(os.environ.get('DEV_MGET_MAX_IDS', 500))
+        self.WARMUP = os.environ.get('DEV_WARMUP', 'true').lower() == 'true'
+        self.QUEUE_MAX_DEPTH = int(os.environ.get('DEV_QUEUE_MAX_DEPTH', 10000))
+        self.QUEUE_MAX_LAG = float(os.environ.get('DEV_QUEUE_MAX_LAG', 30))
+        self.QUEUE_STATS_TTL = float(os.environ.get('DEV_QUEUE_STATS_TTL', 1))
+        self.BACKPRESSURE_RETRY_AFTER = int(os.environ.get('DEV_BACKPRESSURE_RETRY_AFTER', 5))
+        self.RATE_LIMIT_WRITES = float(os.environ.get('DEV_RATE_LIMIT_WRITES', 10))
+        self.RATE_LIMIT_BURST = float(os.environ.get('DEV_RATE_LIMIT_BURST', 20))
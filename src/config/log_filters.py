@@ -0,0 +1,36 @@
+import logging
+import threading
+import time
+
+class RateLimitFilter(logging.Filter):
+    # Token bucket per logger name, applied only to records at or below max_level
+    # so that hot-path debug messages cannot flood the log queue
+    def __init__(self, rate: float, burst: float, max_level: int = logging.DEBUG):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_level = max_level
+        self.buckets = {}
+        self.dropped = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.max_level or self.rate <= 0:
+            return True
+
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(record.name, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[record.name] = (tokens, now)
+                self.dropped[record.name] = self.dropped.get(record.name, 0) + 1
+                return False
+            self.buckets[record.name] = (tokens - 1, now)
+            dropped = self.dropped.pop(record.name, 0)
+
+        if dropped:
+            # let the reader know messages were suppressed since the last one
+            record.msg = "%s (suppressed %d similar messages)" % (record.getMessage(), dropped)
+            record.args = None
+        return True
@@ -1,10 +1,13 @@
 import json
+import logging
 
 class LogFormatter():
+    time_formatter = logging.Formatter()
+
     def custom_formatter(record):
         # escaped_message = record.getMessage().replace('"', '\"')
         log_entry = {
-            "timestamp": record.asctime,
+            "timestamp": getattr(record, "asctime", None) or LogFormatter.time_formatter.formatTime(record),
             "level": record.levelname,
             "logger": record.module,
             "message": record.getMessage()
@@ -1,8 +1,10 @@
 import pika
 import json
 import os
+import signal
+import time
 import threading
-from src import plan_model, config
+from src import plan_model, queue_model, config
 import logging
 
 logger = logging.getLogger(__name__)
@@ -10,18 +12,16 @@ logger = logging.getLogger(__name__)
 class RabbitMQConsumer(threading.Thread):
     def __init__(self):
         super().__init__()
-        self.connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host=os.getenv('RABBITMQ_HOST', 'localhost'))
-        )
-        self.channel = self.connection.channel()
-        self.channel.queue_declare(queue='plans')
+        self.connection = None
+        self.channel = None
     
     def process_message_callback(self, plan_data):
         logger.info("Processing plan data")
         # Implement your logic here
         if plan_data['action'] == 'create':
             logger.info("Creating plan in Redis and ElasticSearch")
-            plan_model.create_plan(plan_data['data'])
+            if not plan_model.create_plan(plan_data['data']):
+                logger.warning("Plan %s already exists, skipping create", plan_data['data'].get('objectId'))
         elif plan_data['action'] == 'delete':
             logger.info("Deleting plan in Redis and ElasticSearch")
             plan_model.delete_plan_etag(plan_data['data'])
@@ -38,15 +38,43 @@ class RabbitMQConsumer(threading.Thread):
             except Exception as e:
                 logger.error(str(e))
             finally:
+                # the lag read by the API's admission control
+                try:
+                    queue_model.record_lag(plan_data.get("published_at", time.time()))
+                except Exception as e:
+                    logger.warning("Could not record consumer lag -> %s", e)
                 ch.basic_ack(delivery_tag=method.delivery_tag)
                 logger.info("Queued item processing completed")
 
+        # connected in the consuming thread, a blocking connection must stay on one thread
+        self.connection = pika.BlockingConnection(
+            pika.ConnectionParameters(host=os.getenv('RABBITMQ_HOST', 'localhost'))
+        )
+        self.channel = self.connection.channel()
+        self.channel.queue_declare(queue='plans')
         self.channel.basic_qos(prefetch_count=1)
         self.channel.basic_consume(queue='plans', on_message_callback=callback)
 
         logger.info('RabbitMQ is ready')
-        self.channel.start_consuming()
+        try:
+            self.channel.start_consuming()
+        finally:
+            if self.connection.is_open:
+                self.connection.close()
 
     def stop(self):
-        self.channel.stop_consuming()
-        self.connection.close()
+        # safe from other threads and signal handlers, consuming stops inside the I/O loop
+        if self.connection and self.connection.is_open:
+            self.connection.add_callback_threadsafe(self.channel.stop_consuming)
+
+# Usage: python -m src.consumer, scaled independently of the API processes
+def main():
+    consumer = RabbitMQConsumer()
+    signal.signal(signal.SIGTERM, lambda signum, frame: consumer.stop())
+    try:
+        consumer.run()
+    except KeyboardInterrupt:
+        logger.info("Consumer interrupted")
+
+if __name__ == "__main__":
+    main()
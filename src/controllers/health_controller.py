@@ -0,0 +1,68 @@
+from flask import Response, json, Blueprint
+from src import plan_model, es_config, queue_model, startup
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# health blueprint, probes are not authenticated
+health = Blueprint("health", __name__)
+
+def check_redis() -> bool:
+    return bool(plan_model.redis_client.ping())
+
+def check_elasticsearch() -> bool:
+    return es_config.conn.ping() and es_config.ensure_index(force=True)
+
+def check_rabbitmq() -> bool:
+    return queue_model.check()
+
+DEPENDENCY_CHECKS = {
+    "redis": check_redis,
+    "elasticsearch": check_elasticsearch,
+    "rabbitmq": check_rabbitmq
+}
+
+def check_dependency(check) -> dict:
+    started = time.perf_counter()
+    try:
+        status = "ok" if check() else "unavailable"
+        error = None
+    except Exception as e:
+        status, error = "unavailable", str(e)
+    result = {"status": status, "latency_ms": round((time.perf_counter() - started) * 1000, 1)}
+    if error:
+        result["error"] = error
+    return result
+
+@health.route('/healthz', methods=['GET'])
+def liveness_controller() -> Response:
+    # the process is up and serving, dependencies are not checked
+    return Response(
+        response=json.dumps({
+            "status": "ok",
+            "pid": os.getpid(),
+            "uptime_s": round(time.perf_counter() - startup["started"], 1),
+            "startup_ms": startup["startup_ms"],
+            "warmup_ms": startup["warmup_ms"],
+            "first_request_ms": startup["first_request_ms"]
+        }),
+        status=200,
+        mimetype="application/json"
+    )
+
+@health.route('/readyz', methods=['GET'])
+def readiness_controller() -> Response:
+    dependencies = {name: check_dependency(check) for name, check in DEPENDENCY_CHECKS.items()}
+    ready = all(dependency["status"] == "ok" for dependency in dependencies.values())
+    if not ready:
+        logger.warning("Not ready -> %s", dependencies)
+    return Response(
+        response=json.dumps({
+            "status": "ready" if ready else "not ready",
+            "dependencies": dependencies
+        }),
+        status=200 if ready else 503,
+        mimetype="application/json"
+    )
@@ -1,23 +1,54 @@
 from flask import request, Response, json, Blueprint
+from werkzeug.http import generate_etag, parse_etags
 from src.middlewares.auth_middleware import authorization_required
-from src import plan_model, etag_model
+from src.middlewares.compression_middleware import compress_response, get_representation_etag
+from src.middlewares.rate_limit_middleware import admission_control
+from src.utils import SingleFlight
+from src import plan_model, etag_model, queue_model, config
 import logging
-import pika
-import os
 
 logger = logging.getLogger(__name__)
 
 # plans controller blueprint to be registered with api blueprint
 plans = Blueprint("plans", __name__)
+plans.after_request(compress_response)
 
-# Setup RabbitMQ connection
-connection = pika.BlockingConnection(pika.ConnectionParameters(host=os.getenv('RABBITMQ_HOST', 'localhost')))
-channel = connection.channel()
-channel.queue_declare(queue='plans')
+# concurrent reads of the same plan share one backend fetch and serialized body
+plan_reads = SingleFlight(
+    plan_model.redis_client if config.SINGLE_FLIGHT_REDIS else None,
+    lock_ms=config.SINGLE_FLIGHT_LOCK_MS
+)
+
+def get_request_etags(header: str, include_weak=True) -> list:
+    # unquoted ETags of a conditional header, compressed variants map back to their plan ETag
+    etags = parse_etags(request.headers.get(header))
+    return [get_representation_etag(etag) for etag in etags.as_set(include_weak=include_weak)]
+
+def get_projection() -> tuple:
+    # ?fields=planType,linkedPlanServices.linkedService&depth=0|1|2
+    depth = request.args.get("depth", "2")
+    if depth not in ("0", "1", "2"):
+        raise ValueError("depth must be 0, 1 or 2")
+    return plan_model.parse_fields(request.args.get("fields")), int(depth)
+
+def fetch_plan_response(plan_id: str, get_plan, weak=False) -> dict:
+    # projected bodies get weak ETags, a client can not update a plan it never fully read
+    plan_data = get_plan(plan_id)
+    if not plan_data:
+        return None
+    body = json.dumps(plan_data)
+    etag_value = generate_etag(body.encode("utf-8"))
+    logger.info("Saved Etag value - %s", etag_value)
+    plan_model.create_etag(plan_id, etag_value, weak)
+    return {"body": body, "etag": etag_value, "weak": weak}
+
+def is_projected(fields: dict, depth: int) -> bool:
+    return fields is not None or depth != 2
 
 @plans.route('', methods=['POST', 'GET'])
 @authorization_required
-def create_plan(_: dict) -> Response:
+@admission_control
+def create_plan(user: dict) -> Response:
     plan_data_obj = None
     try:
         if request.method == 'POST':
@@ -38,8 +69,8 @@ def create_plan(_: dict) -> Response:
                         mimetype="application/json"
                     )
 
-                channel.basic_publish(exchange='', routing_key='plans', body=json.dumps(message))
-                logger.info("Published create message to RabbitMQ")
+                queue_model.publish(message)
+                logger.info("Published create message to RabbitMQ for %s", user["email"])
                 response = Response(
                     response=json.dumps({
                         "status": "success",
@@ -67,8 +98,8 @@ def create_plan(_: dict) -> Response:
         else:
             try:
                 logger.info("Fetched multiple plans")
-                if_none_match = request.headers.get('If-None-Match')
-                if if_none_match and etag_model.check_key_exists(if_none_match):
+                if_none_match = get_request_etags('If-None-Match')
+                if any(etag_model.check_key_exists(etag) for etag in if_none_match):
                     logger.warning("Content not modified")
                     return Response(status=304)
                 
@@ -91,7 +122,7 @@ def create_plan(_: dict) -> Response:
                 )
                 response.add_etag()
                 etag_value = response.headers.get("Etag").strip('\"')
-                logger.info("Saved Etag value - {}".format(etag_value))
+                logger.info("Saved Etag value - %s", etag_value)
                 etag_model.save_etag(etag_value, plan_data)
                 return response
             except Exception as e:
@@ -117,20 +148,15 @@ def create_plan(_: dict) -> Response:
 
 @plans.route('/<plan_id>', methods=['GET', 'PUT', 'PATCH', 'DELETE'])
 @authorization_required
-def plans_controller(_: dict, plan_id: str) -> Response:
+@admission_control
+def plans_controller(user: dict, plan_id: str) -> Response:
     try:
         # Put Request
         if request.method == 'PUT':
             return Response(status=400)
         # Delete request
         elif request.method == 'DELETE':
-            message = {
-                'action': 'create',
-                'data': plan_id
-            }
-            channel.basic_publish(exchange='', routing_key='plans', body=json.dumps(message))
-            logger.info("Published update message to RabbitMQ")
-            if plan_model.check_key_exists(plan_id):
+            if not plan_model.check_key_exists(plan_id):
                 logger.info("Plan not found")
                 return Response(
                     response=json.dumps({
@@ -140,7 +166,13 @@ def plans_controller(_: dict, plan_id: str) -> Response:
                     status=404,
                     mimetype="application/json"
                 )
-            logger.info("Plan deleted successfully - {}".format(plan_id))
+            message = {
+                'action': 'delete',
+                'data': plan_id
+            }
+            queue_model.publish(message)
+            logger.info("Published delete message to RabbitMQ for %s", user["email"])
+            logger.info("Plan deleted successfully - %s", plan_id)
             return Response(
                 response=json.dumps({
                     "status": "success",
@@ -151,8 +183,13 @@ def plans_controller(_: dict, plan_id: str) -> Response:
             )
         # PATCH request
         elif request.method == 'PATCH':
-            if_match = request.headers.get('If-Match')
-            if if_match and not plan_model.check_etag_exists(if_match):
+            # strong comparison, a header with only weak ETags never matches
+            # and "*" matches any current representation of the plan
+            if parse_etags(request.headers.get('If-Match')).star_tag:
+                matched = plan_model.check_key_exists(plan_id)
+            else:
+                matched = any(plan_model.check_etag_exists(plan_id, etag) for etag in get_request_etags('If-Match', include_weak=False))
+            if request.headers.get('If-Match') and not matched:
                 logger.warning("No ETAG found")
                 return Response(status=412)
             
@@ -165,11 +202,11 @@ def plans_controller(_: dict, plan_id: str) -> Response:
                         **plan_data_obj
                     }
                 }
-                channel.basic_publish(exchange='', routing_key='plans', body=json.dumps(message))
-                logger.info("Published update message to RabbitMQ")
+                queue_model.publish(message)
+                logger.info("Published update message to RabbitMQ for %s", user["email"])
                 # plan_data = plan_model.update_plan_partial(plan_id, plan_data_obj)
                 
-                logger.info("Plan data updated successfully - {}".format(plan_id))
+                logger.info("Plan data updated successfully - %s", plan_id)
                 response = Response(
                     # response=json.dumps(plan_data),
                     response=json.dumps({
@@ -207,13 +244,31 @@ def plans_controller(_: dict, plan_id: str) -> Response:
         # Get Request
         else:
             logger.info("Fetching plan data")
-            if_none_match = request.headers.get('If-None-Match')
-            if if_none_match and plan_model.check_etag_exists(if_none_match):
+            if_none_match = get_request_etags('If-None-Match')
+            if any(plan_model.check_etag_exists(plan_id, etag, weak=True) for etag in if_none_match):
                 logger.warning("Content not modified")
                 return Response(status=304)
             
-            plan_data = plan_model.get_complete_plan(plan_id)
-            if not plan_data:
+            try:
+                fields, depth = get_projection()
+            except ValueError as e:
+                logger.warning(str(e))
+                return Response(
+                    response=json.dumps({
+                        "status": "failed",
+                        "message": str(e)
+                    }),
+                    status=400,
+                    mimetype="application/json"
+                )
+
+            plan_response = plan_reads.do(
+                "plan:{}:{}:{}".format(plan_id, depth, request.args.get("fields", "")),
+                lambda: fetch_plan_response(
+                    plan_id, lambda plan_id: plan_model.get_complete_plan(plan_id, fields, depth), is_projected(fields, depth)
+                )
+            )
+            if not plan_response:
                 logger.info("No plan found")
                 return Response(
                     response=json.dumps({
@@ -225,14 +280,11 @@ def plans_controller(_: dict, plan_id: str) -> Response:
                 )
             logger.info("Fetched plan data")
             response = Response(
-                response=json.dumps(plan_data),
+                response=plan_response["body"],
                 status=200,
                 mimetype="application/json",
             )
-            response.add_etag()
-            etag_value = response.headers.get("Etag").strip('\"')
-            logger.info("Saved Etag value - {}".format(etag_value))
-            plan_model.create_etag(plan_id, etag_value)
+            response.set_etag(plan_response["etag"], plan_response["weak"])
             return response
     except Exception as e:
         logger.error(str(e))
@@ -250,13 +302,31 @@ def plans_controller(_: dict, plan_id: str) -> Response:
 def es_plan_data_controller(_: dict, plan_id: str) -> Response:
     try:
         logger.info("Fetching plan from es data")
-        if_none_match = request.headers.get('If-None-Match')
-        if if_none_match and plan_model.check_etag_exists(if_none_match):
+        if_none_match = get_request_etags('If-None-Match')
+        if any(plan_model.check_etag_exists(plan_id, etag, weak=True) for etag in if_none_match):
             logger.warning("Content not modified")
             return Response(status=304)
         
-        plan_data = plan_model.get_complete_plan_es(plan_id)
-        if not plan_data:
+        try:
+            fields, depth = get_projection()
+        except ValueError as e:
+            logger.warning(str(e))
+            return Response(
+                response=json.dumps({
+                    "status": "failed",
+                    "message": str(e)
+                }),
+                status=400,
+                mimetype="application/json"
+            )
+
+        plan_response = plan_reads.do(
+            "es_plan:{}:{}:{}".format(plan_id, depth, request.args.get("fields", "")),
+            lambda: fetch_plan_response(
+                plan_id, lambda plan_id: plan_model.get_complete_plan_es(plan_id, fields, depth), is_projected(fields, depth)
+            )
+        )
+        if not plan_response:
             logger.info("No plan found")
             return Response(
                 response=json.dumps({
@@ -268,14 +338,11 @@ def es_plan_data_controller(_: dict, plan_id: str) -> Response:
             )
         logger.info("Fetched plan data")
         response = Response(
-            response=json.dumps(plan_data),
+            response=plan_response["body"],
             status=200,
             mimetype="application/json",
         )
-        response.add_etag()
-        etag_value = response.headers.get("Etag").strip('\"')
-        logger.info("Saved Etag value - {}".format(etag_value))
-        plan_model.create_etag(plan_id, etag_value)
+        response.set_etag(plan_response["etag"], plan_response["weak"])
         return response
     except Exception as e:
         logger.error(str(e))
@@ -294,8 +361,8 @@ def es_data_controller(_: dict) -> Response:
     try:
         args = request.args
         logger.info("Fetch plan from ES")
-        if_none_match = request.headers.get('If-None-Match')
-        if if_none_match and plan_model.check_etag_exists(if_none_match):
+        if_none_match = get_request_etags('If-None-Match')
+        if any(plan_model.check_etag_exists(args.get("id"), etag, weak=True) for etag in if_none_match):
             logger.warning("Content not modified")
             return Response(status=304)
         
@@ -322,10 +389,115 @@ def es_data_controller(_: dict) -> Response:
             status=200,
             mimetype="application/json",
         )
+        # raw ES documents are not a complete plan, their ETag is weak
+        response.add_etag(weak=True)
+        etag_value = response.get_etag()[0]
+        logger.info("Saved ES Etag value - %s", etag_value)
+        plan_model.create_etag(args.get("id"), etag_value, weak=True)
+        return response
+    except Exception as e:
+        logger.error(str(e))
+        return Response(
+            response=json.dumps({
+                "status": "failed",
+                "message": str(e)
+            }),
+            status=500,
+            mimetype="application/json"
+        )
+
+@plans.route('/_mget', methods=['POST'])
+@authorization_required
+def mget_controller(_: dict) -> Response:
+    try:
+        logger.info("Fetching multiple complete plans")
+        try:
+            plan_ids = (request.get_json(silent=True) or {}).get("ids")
+            if not isinstance(plan_ids, list) or not plan_ids or not all(isinstance(plan_id, str) for plan_id in plan_ids):
+                raise ValueError("ids must be a non-empty list of plan ids")
+            if len(plan_ids) > config.MGET_MAX_IDS:
+                raise ValueError(f"At most {config.MGET_MAX_IDS} ids can be fetched at once")
+            fields, depth = get_projection()
+        except ValueError as e:
+            logger.warning(str(e))
+            return Response(
+                response=json.dumps({
+                    "status": "failed",
+                    "message": str(e)
+                }),
+                status=400,
+                mimetype="application/json"
+            )
+
+        # every plan graph is resolved together, one MGET per level
+        plans_data = plan_model.get_complete_plans(plan_ids, fields, depth)
+        docs = [
+            {"_id": plan_id, "found": True, "plan": plan_data} if plan_data
+            else {"_id": plan_id, "found": False, "status": 404}
+            for plan_id, plan_data in zip(plan_ids, plans_data)
+        ]
+        logger.info("Fetched %s of %s plans", sum(1 for doc in docs if doc["found"]), len(docs))
+        return Response(
+            response=json.dumps({"docs": docs}),
+            status=200,
+            mimetype="application/json"
+        )
+    except Exception as e:
+        logger.error(str(e))
+        return Response(
+            response=json.dumps({
+                "status": "failed",
+                "message": str(e)
+            }),
+            status=500,
+            mimetype="application/json"
+        )
+
+@plans.route('/_search', methods=['GET'])
+@authorization_required
+def search_controller(_: dict) -> Response:
+    try:
+        args = request.args
+        logger.info("Searching plans in ES")
+
+        # every other query parameter is a filter: [<type>.]<field>[__<gt|gte|lt|lte>]=<value>
+        filters = []
+        for key, value in args.items(multi=True):
+            if key in ("type", "size", "search_after", "agg"):
+                continue
+            name, _, operator = key.partition("__")
+            filter_type, _, field = name.rpartition(".")
+            filters.append((filter_type or None, field, operator or "eq", value))
+
+        try:
+            search_data = plan_model.search_plans(
+                doc_type=args.get("type", "plan"),
+                filters=filters,
+                size=args.get("size", 20, type=int),
+                search_after=args.get("search_after"),
+                aggregations=args.getlist("agg")
+            )
+        except ValueError as e:
+            logger.warning(str(e))
+            return Response(
+                response=json.dumps({
+                    "status": "failed",
+                    "message": str(e)
+                }),
+                status=400,
+                mimetype="application/json"
+            )
+
+        logger.info("Fetched %s search hits from ES", len(search_data["hits"]))
+        response = Response(
+            response=json.dumps(search_data),
+            status=200,
+            mimetype="application/json",
+        )
         response.add_etag()
-        etag_value = response.headers.get("Etag").strip('\"')
-        logger.info("Saved ES Etag value - {}".format(etag_value))
-        plan_model.create_etag(args.get("id"), etag_value)
+        if response.get_etag()[0] in get_request_etags('If-None-Match'):
+            logger.warning("Content not modified")
+            return Response(status=304)
         return response
     except Exception as e:
         logger.error(str(e))
@@ -337,3 +509,60 @@ def es_data_controller(_: dict) -> Response:
             status=500,
             mimetype="application/json"
         )
+
+@plans.route('/<plan_id>/aggregates', methods=['GET'])
+@authorization_required
+def plan_aggregates_controller(_: dict, plan_id: str) -> Response:
+    try:
+        logger.info("Fetching cost share aggregates of plan %s", plan_id)
+        # kept up to date by the consumer, one GET
+        aggregates = plan_model.get_plan_aggregates(plan_id)
+        if not aggregates:
+            logger.info("No plan found")
+            return Response(
+                response=json.dumps({
+                    "status": "failed",
+                    "message": "No plan found"
+                }),
+                status=404,
+                mimetype="application/json"
+            )
+        return Response(
+            response=json.dumps({"_id": plan_id, "aggregates": aggregates}),
+            status=200,
+            mimetype="application/json"
+        )
+    except Exception as e:
+        logger.error(str(e))
+        return Response(
+            response=json.dumps({
+                "status": "failed",
+                "message": str(e)
+            }),
+            status=500,
+            mimetype="application/json"
+        )
+
+@plans.route('/_aggregates', methods=['GET'])
+@authorization_required
+def group_aggregates_controller(_: dict) -> Response:
+    try:
+        # ?_org=example.com&planType=inNetwork reads one group, either alone filters the known groups
+        org, plan_type = request.args.get("_org"), request.args.get("planType")
+        logger.info("Fetching cost share aggregates of _org %s and planType %s", org, plan_type)
+        groups = plan_model.get_group_aggregates(org, plan_type)
+        return Response(
+            response=json.dumps({"groups": groups}),
+            status=200,
+            mimetype="application/json"
+        )
+    except Exception as e:
+        logger.error(str(e))
+        return Response(
+            response=json.dumps({
+                "status": "failed",
+                "message": str(e)
+            }),
+            status=500,
+            mimetype="application/json"
+        )
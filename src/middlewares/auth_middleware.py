@@ -64,11 +64,11 @@ def authorization_required(f):
                 )
         except Exception as e:
             if (type(e) == jwt.InvalidAudienceError):
-                logger.error("Invalid Client ID -> {}".format(str(e)))
+                logger.error("Invalid Client ID -> %s", e)
             elif (type(e) == jwt.ExpiredSignatureError):
-                logger.warning("Expired Signature -> {}".format(str(e)))
+                logger.warning("Expired Signature -> %s", e)
             elif (type(e) == jwt.DecodeError):
-                logger.warning("Decode error -> {}".format(str(e)))
+                logger.warning("Decode error -> %s", e)
             else:
                 logger.error(str(e))
                 return Response(
@@ -88,7 +88,7 @@ def authorization_required(f):
                 mimetype="application/json"
             )
 
-        logger.info("Validated User - {}".format(user["email"]))
+        logger.info("Validated User - %s", user["email"])
         return f(user, *args, **kwargs)
 
     return decorated
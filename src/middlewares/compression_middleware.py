@@ -0,0 +1,87 @@
+import gzip
+import threading
+import logging
+from collections import OrderedDict
+from flask import request, Response
+from src import config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+ENCODINGS = ["br", "gzip"] if brotli else ["gzip"]
+
+class CompressedBodyCache:
+    # LRU of compressed bodies keyed by (etag, encoding), bounded by total size
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.bodies = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            body = self.bodies.get(key)
+            if body is not None:
+                self.bodies.move_to_end(key)
+            return body
+
+    def put(self, key, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.bodies:
+                return
+            self.bodies[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self.bodies.popitem(last=False)
+                self.size -= len(evicted)
+
+compressed_bodies = CompressedBodyCache(config.COMPRESSION_CACHE_BYTES)
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+def get_representation_etag(etag: str) -> str:
+    # ETag of the uncompressed representation for an ETag sent back by a client
+    for encoding in ENCODINGS:
+        if etag.endswith(f"-{encoding}"):
+            return etag[:-len(encoding) - 1]
+    return etag
+
+def compress_response(response: Response) -> Response:
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or response.mimetype != "application/json"
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if len(body) < config.COMPRESSION_MIN_SIZE or not encoding:
+        return response
+
+    etag, weak = response.get_etag()
+    compressed = compressed_bodies.get((etag, encoding)) if etag else None
+    if compressed is None:
+        compressed = compress(body, encoding)
+        if etag:
+            compressed_bodies.put((etag, encoding), compressed)
+    else:
+        logger.debug("Served cached %s body for %s", encoding, etag)
+
+    # each encoding is a different representation, so it gets its own ETag
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    return response
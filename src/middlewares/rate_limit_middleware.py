@@ -0,0 +1,86 @@
+from functools import wraps
+from flask import request, Response, json
+import math
+import logging
+from src import plan_model, queue_model, config
+
+logger = logging.getLogger(__name__)
+
+# methods that publish to the plans queue
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+class TokenBucket:
+    # Per key token bucket kept in Redis, refilled at rate tokens per second up to burst.
+    # The script reads the Redis clock so every API process shares the same buckets
+    TAKE_SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate)
+    local retry_after = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        retry_after = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+    return tostring(retry_after)
+    """
+
+    def __init__(self, redis_client, rate: float, burst: float, key_prefix: str = "ratelimit"):
+        self.rate = rate
+        self.burst = burst
+        self.key_prefix = key_prefix
+        self.take_script = redis_client.register_script(self.TAKE_SCRIPT)
+
+    def take(self, key: str) -> float:
+        # 0 when a token was taken, otherwise seconds until the next one
+        return float(self.take_script(keys=[f"{self.key_prefix}:{{{key}}}"], args=[self.rate, self.burst]))
+
+write_limits = TokenBucket(plan_model.redis_client, config.RATE_LIMIT_WRITES, config.RATE_LIMIT_BURST)
+
+def rejected(status: int, message: str, retry_after: float) -> Response:
+    return Response(
+        response=json.dumps({
+            "status": "failed",
+            "message": message
+        }),
+        status=status,
+        mimetype="application/json",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+def admission_control(f):
+    # Sheds writes before they are queued: 503 while the queue is deeper or the consumer
+    # later than configured, then 429 once the user's token bucket is empty. The backlog is
+    # checked first so a shed write does not cost a token.
+    # Stacked under authorization_required, which passes the user first
+    @wraps(f)
+    def decorated(user, *args, **kwargs):
+        if request.method not in WRITE_METHODS:
+            return f(user, *args, **kwargs)
+
+        try:
+            backlog = queue_model.get_backlog()
+        except Exception as e:
+            logger.error("Could not read the plans queue depth -> %s", e)
+            return rejected(503, "Plan updates are unavailable", config.BACKPRESSURE_RETRY_AFTER)
+
+        if backlog["depth"] >= config.QUEUE_MAX_DEPTH or backlog["lag"] >= config.QUEUE_MAX_LAG:
+            logger.warning("Shedding write, plans queue backlog -> %s", backlog)
+            return rejected(503, "Too many pending plan updates", min(60, max(config.BACKPRESSURE_RETRY_AFTER, backlog["lag"])))
+
+        if config.RATE_LIMIT_WRITES > 0:
+            retry_after = write_limits.take(user["email"])
+            if retry_after:
+                logger.warning("Write rate limit reached - %s", user["email"])
+                return rejected(429, "Too many requests", retry_after)
+
+        return f(user, *args, **kwargs)
+
+    return decorated
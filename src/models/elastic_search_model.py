@@ -1,55 +1,244 @@
 import json
-from elasticsearch import Elasticsearch
+import os
+import threading
+import time
+from elasticsearch import Elasticsearch, NotFoundError, helpers
 from src import config
 import logging
 
 logger = logging.getLogger(__name__)
 
 class ElasticSearchConfig:
+    # read/write alias used by the application, physical indices are "<alias>_v<version>"
+    INDEX_ALIAS = "plans"
+    BULK_LOAD_SETTINGS = {"number_of_replicas": 0, "refresh_interval": "-1"}
+    # seconds writes wait before checking an unavailable index again
+    INDEX_RETRY_INTERVAL = 5.0
+    # seconds between two polls of a running reindex task
+    REINDEX_POLL_INTERVAL = 5.0
+
     def __init__(self):
-        self.conn = self.connect_elasticsearch()
+        self._conn = None
+        self._conn_pid = None
+        self._conn_lock = threading.Lock()
+        self.index_ready = False
+        self.index_checked = 0.0
+        os.register_at_fork(after_in_child=self.reset_connection)
+
+    def reset_connection(self):
+        # the lock may have been held by another thread of the parent at fork time
+        self._conn_lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def conn(self):
+        # Connected on first use in each process, a client inherited from the
+        # parent of a forked worker shares its sockets and is never reused
+        if self._conn is None or self._conn_pid != os.getpid():
+            with self._conn_lock:
+                if self._conn is None or self._conn_pid != os.getpid():
+                    self._conn = self.connect_elasticsearch()
+                    self._conn_pid = os.getpid()
+        return self._conn
 
     def connect_elasticsearch(self, **kwargs):
+        # the client only connects on its first request, see ensure_index
         _es_config = config.ELASTIC_HOST
         _es_hosts = [_es_config]
         if 'hosts' in kwargs.keys():
             _es_hosts = kwargs['hosts']
         _es_obj = None
         _es_obj = Elasticsearch(hosts=_es_hosts, timeout=10)
+        return _es_obj
 
-        if _es_obj.ping():
+    def ensure_index(self, force=False) -> bool:
+        # Creates the versioned index and alias if needed. Called by the warmup, the
+        # readiness probe and before writes, so it is retried until ElasticSearch is up.
+        # Writes only check again every INDEX_RETRY_INTERVAL, an unreachable cluster
+        # would otherwise cost each of them a ping timeout
+        if self.index_ready:
+            return True
+        if not force and time.monotonic() - self.index_checked < self.INDEX_RETRY_INTERVAL:
+            return False
+        self.index_checked = time.monotonic()
+        if self.conn.ping():
             logger.info("Connection to ElasticSearch successfull")
 
             # Create indices
-            INDEX_NAME = "plans"
-            mappings = json.load(open("src/models/planMappings.json"))
-
             try:
-                if not _es_obj.indices.exists(INDEX_NAME):
-                    _es_obj.indices.create(index=INDEX_NAME, body=mappings)
-                    logger.info("Indices created successfully")
-                    return
-                logger.info("Indices already exists")
+                self.create_versioned_index(self.conn, config.ELASTIC_INDEX_VERSION)
+                self.index_ready = True
             except Exception as e:
-                logger.error("{}".format(str(e)))
+                logger.error("%s", e)
         else:
             logger.error("Could not connect to ElasticSearch")
-        
-        return _es_obj
+        return self.index_ready
+
+    def require_index(self):
+        # writes to the alias before it exists would auto create an unmapped index
+        if not self.ensure_index():
+            raise RuntimeError(f"Index {self.INDEX_ALIAS} is not available")
+
+    def get_index_name(self, version) -> str:
+        return f"{self.INDEX_ALIAS}_v{version}"
+
+    def load_mappings(self) -> dict:
+        with open("src/models/planMappings.json") as mappings_file:
+            return json.load(mappings_file)
+
+    def get_alias_indices(self, conn=None) -> list:
+        conn = conn or self.conn
+        try:
+            return list(conn.indices.get_alias(name=self.INDEX_ALIAS).keys())
+        except NotFoundError:
+            return []
+
+    def create_versioned_index(self, conn, version):
+        if conn.indices.exists_alias(name=self.INDEX_ALIAS):
+            logger.info("Indices already exists")
+            return
+        if conn.indices.exists(index=self.INDEX_ALIAS):
+            logger.warning("Index %s is not versioned, run the reindex script to move it behind an alias", self.INDEX_ALIAS)
+            return
+
+        body = self.load_mappings()
+        body["aliases"] = {self.INDEX_ALIAS: {"is_write_index": True}}
+        conn.indices.create(index=self.get_index_name(version), body=body)
+        logger.info("Indices created successfully")
+
+    def get_bulk_settings(self, index) -> dict:
+        settings = self.conn.indices.get_settings(index=index)[index]["settings"]["index"]
+        return {
+            "number_of_replicas": settings.get("number_of_replicas", "1"),
+            "refresh_interval": settings.get("refresh_interval", "1s")
+        }
+
+    def start_bulk_load(self, index) -> dict:
+        # returns the settings to hand back to restore_bulk_settings
+        settings = self.get_bulk_settings(index)
+        self.conn.indices.put_settings(index=index, body={"index": self.BULK_LOAD_SETTINGS})
+        return settings
+
+    def restore_bulk_settings(self, index, settings):
+        self.conn.indices.put_settings(index=index, body={"index": settings})
+        self.conn.indices.refresh(index=index)
+        self.conn.cluster.health(index=index, wait_for_status="yellow", request_timeout=300)
+
+    def reindex(self, version, slices="auto", delete_old=False) -> dict:
+        source_indices = self.get_alias_indices()
+        legacy = not source_indices and self.conn.indices.exists(index=self.INDEX_ALIAS)
+        if legacy:
+            source_indices = [self.INDEX_ALIAS]
+        if len(source_indices) != 1:
+            raise ValueError(f"Expected exactly one index behind {self.INDEX_ALIAS}, found {source_indices}")
+
+        source_index = source_indices[0]
+        target_index = self.get_index_name(version)
+        if source_index == target_index or self.conn.indices.exists(index=target_index):
+            raise ValueError(f"Index {target_index} already exists")
+
+        # settings to restore once the bulk load is done
+        restore_settings = self.get_bulk_settings(source_index)
+
+        body = self.load_mappings()
+        body["settings"] = {"index": self.BULK_LOAD_SETTINGS}
+        self.conn.indices.create(index=target_index, body=body)
+        logger.info("Created index %s for reindex from %s", target_index, source_index)
+
+        # The copy runs as a task polled until it completes. The target is only served once
+        # every document was copied, otherwise the task is cancelled and the target deleted
+        task_id, swapped = None, False
+        try:
+            task_id = self.conn.reindex(
+                body={"source": {"index": source_index, "size": 5000}, "dest": {"index": target_index}},
+                slices=slices,
+                wait_for_completion=False
+            )["task"]
+            result = self.wait_for_task(task_id)
+            task_id = None
+            if result.get("failures") or result.get("timed_out"):
+                raise RuntimeError("Reindex into {} failed, timed out: {}, failures: {}".format(
+                    target_index, result.get("timed_out"), result.get("failures", [])[:5]
+                ))
+            logger.info("Reindexed %s documents into %s", result.get("total"), target_index)
+
+            self.restore_bulk_settings(target_index, restore_settings)
+
+            # Writes made while the copy ran are not copied from the source index, a copy can
+            # not tell a stale document from a newer one or a deleted one. The caller replays
+            # the plans changed since the copy started from Redis, see reindex_es
+            if legacy:
+                actions = [{"remove_index": {"index": source_index}}]
+            else:
+                actions = [{"remove": {"index": source_index, "alias": self.INDEX_ALIAS}}]
+            actions.append({"add": {"index": target_index, "alias": self.INDEX_ALIAS, "is_write_index": True}})
+            self.conn.indices.update_aliases(body={"actions": actions})
+            swapped = True
+            logger.info("Swapped alias %s from %s to %s", self.INDEX_ALIAS, source_index, target_index)
+        finally:
+            if not swapped:
+                self.discard_reindex(target_index, task_id)
+
+        if not legacy and delete_old:
+            self.conn.indices.delete(index=source_index)
+            logger.info("Deleted index %s", source_index)
+
+        return {"source": source_index, "target": target_index, "total": result.get("total", 0)}
     
+    def wait_for_task(self, task_id) -> dict:
+        # response of a task once it completes, logging its progress in between
+        while True:
+            task = self.conn.tasks.get(task_id=task_id)
+            if task.get("completed"):
+                if task.get("error"):
+                    raise RuntimeError(f"Task {task_id} failed -> {task['error']}")
+                return task.get("response", {})
+            status = task.get("task", {}).get("status", {})
+            logger.info("Task %s copied %s of %s documents", task_id, status.get("created", 0) + status.get("updated", 0), status.get("total"))
+            time.sleep(self.REINDEX_POLL_INTERVAL)
+
+    def discard_reindex(self, target_index, task_id=None):
+        # a running copy would create the target again, it is cancelled before the delete
+        try:
+            if task_id:
+                self.conn.tasks.cancel(task_id=task_id)
+            self.conn.indices.delete(index=target_index, ignore=[404])
+            logger.warning("Discarded index %s of a failed reindex", target_index)
+        except Exception as e:
+            logger.error("Could not discard index %s -> %s", target_index, e)
+
     def bulk_operations(self, data):
         try:
+            self.require_index()
             self.conn.bulk(data)
             logger.info("Bulk operations completed successfully")
         except Exception as e:
             logger.error(str(e))
     
+    def bulk_index(self, actions, chunk_size=1000, max_retries=3):
+        # returns (successful actions, failed action results) instead of raising
+        success, errors = 0, []
+        self.require_index()
+        for ok, result in helpers.streaming_bulk(
+            self.conn, actions, chunk_size=chunk_size, max_retries=max_retries,
+            raise_on_error=False, raise_on_exception=False
+        ):
+            if ok:
+                success += 1
+            else:
+                errors.append(result)
+        logger.debug("Bulk indexed %s actions with %s errors", success, len(errors))
+        return success, errors
+    
     def create_index(self, **kwargs):
         try:
+            self.require_index()
             self.conn.index(**kwargs)
-            logger.info("Created index with id -> {}".format(kwargs.get("id", "None")))
+            logger.debug("Created index with id -> %s", kwargs.get("id", "None"))
+            return True
         except Exception as e:
             logger.error(str(e))
+            return False
     
     def update_index(self, **kwargs):
         try:
@@ -57,16 +246,29 @@ class ElasticSearchConfig:
                 "doc": kwargs.get("body"),
                 "doc_as_upsert" : True
             }
+            self.require_index()
             self.conn.update(**kwargs)
-            logger.info("Updated index with id -> {}".format(kwargs.get("id", "None")))
+            logger.debug("Updated index with id -> %s", kwargs.get("id", "None"))
+            return True
         except Exception as e:
             logger.error(str(e))
+            return False
     
+    def get_documents(self, ids, **kwargs) -> dict:
+        # id -> _source of the documents found, routing defaults to the id so use it for root documents
+        if not ids:
+            return {}
+        data = self.conn.mget(index=self.INDEX_ALIAS, body={"ids": list(ids)}, **kwargs)
+        return {doc["_id"]: doc.get("_source", {}) for doc in data["docs"] if doc.get("found")}
+
+    def delete_by_query(self, query):
+        return self.conn.delete_by_query(index=self.INDEX_ALIAS, body={"query": query}, conflicts="proceed", refresh=True)
+
     def search_index(self, **kwargs):
         data = None
         try:
             data = self.conn.search(**kwargs)
-            logger.info("Found index")
+            logger.debug("Found index")
         except Exception as e:
             logger.error(str(e))
 
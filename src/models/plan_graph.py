@@ -0,0 +1,168 @@
+import json
+from collections import namedtuple
+
+# records: Redis key -> stored JSON, root first. actions: ES bulk index actions, root first.
+# documents: [id, routing] of every ES document. keys: Redis keys of the child objects.
+# Every descendant is routed by the root id, a join needs the whole plan on one shard
+Decomposition = namedtuple("Decomposition", ["records", "actions", "documents", "keys"])
+
+def wants_field(fields: dict, key: str) -> bool:
+    return fields is None or key in fields
+
+def get_subfields(fields: dict, key: str) -> dict:
+    # None means every field of the subtree
+    return (fields[key] or None) if fields is not None and key in fields else None
+
+def get_reference(data: dict) -> str:
+    return data["objectType"] + ":" + data["objectId"]
+
+class GraphNode:
+    # one object type of the plan graph, children maps field -> (is list, child node)
+    __slots__ = ("relation", "children")
+
+    def __init__(self, relation: str):
+        self.relation = relation
+        self.children = {}
+
+class PlanGraph:
+    # Decomposes plans into stored objects and ES join documents, and assembles them back.
+    # The graph is compiled from the "x-join" relation of every object in the JSON schema,
+    # checked against the join field relations of the ES mappings
+    def __init__(self, schema: dict, mappings: dict, root_key, child_key):
+        relations = mappings.get("mappings", {}).get("properties", {}).get("join_field", {}).get("relations", {})
+        self.join_parents = {child: parent for parent, children in relations.items() for child in children}
+        self.root_key = root_key
+        self.child_key = child_key
+        self.root = self.compile_node(schema)
+
+    def compile_node(self, schema: dict) -> GraphNode:
+        node = GraphNode(schema.get("x-join"))
+        for field, field_schema in schema.get("properties", {}).items():
+            many = field_schema.get("type") == "array"
+            item_schema = field_schema.get("items", {}) if many else field_schema
+            if "x-join" not in item_schema:
+                continue
+            child = self.compile_node(item_schema)
+            if self.join_parents.get(child.relation) != node.relation:
+                raise ValueError(f"{child.relation} is not a child of {node.relation} in the join field relations")
+            node.children[field] = (many, child)
+        return node
+
+    def decompose(self, plan: dict, index: str, content_hash=None, with_records=True) -> Decomposition:
+        # One preorder walk: every object is read once, its stored value and ES document are
+        # built in the same loop over its fields and the input plan is never modified.
+        # with_records=False skips the JSON encoding when only the ES side is needed
+        root_id = plan["objectId"]
+        records, actions, documents, keys = {}, [], [], []
+
+        def visit(data, node, key, parent_id):
+            children = node.children
+            pending = []
+            if children:
+                document, stored = {}, {}
+                for field, value in data.items():
+                    child = children.get(field)
+                    if child is None:
+                        document[field] = stored[field] = value
+                    elif child[0]:
+                        stored[field] = references = []
+                        for item in value or ():
+                            reference = get_reference(item)
+                            references.append(reference)
+                            pending.append((item, reference, child[1]))
+                    elif value:
+                        stored[field] = reference = get_reference(value)
+                        pending.append((value, reference, child[1]))
+                    else:
+                        stored[field] = value
+                if with_records:
+                    records[key] = json.dumps(stored)
+            else:
+                if with_records:
+                    records[key] = json.dumps(data)
+                document = dict(data)
+
+            object_id = data["objectId"]
+            if parent_id:
+                document["join_field"] = {"name": node.relation, "parent": parent_id}
+                actions.append({"_index": index, "_id": object_id, "_source": document, "_routing": root_id})
+                documents.append([object_id, root_id])
+            else:
+                document["join_field"] = {"name": node.relation}
+                actions.append({"_index": index, "_id": object_id, "_source": document})
+                documents.append([object_id, None])
+
+            for item, reference, child in pending:
+                child_key = self.child_key(root_id, reference)
+                keys.append(child_key)
+                visit(item, child, child_key, object_id)
+
+        visit(plan, self.root, self.root_key(root_id), None)
+        if content_hash:
+            actions[0]["_source"]["content_hash"] = content_hash
+        return Decomposition(records, actions, documents, keys)
+
+    def assemble(self, roots: list, get_values, fields=None, depth=2) -> list:
+        # Resolves the references of many stored roots in place, one get_values (MGET) call
+        # per level. Subtrees outside depth or fields are not fetched
+        level = [(root, root["objectId"], self.root, fields) for root in roots]
+        for _ in range(depth):
+            # (container, slot, key, root id, child node, child fields) of every reference
+            pending = []
+            for data, root_id, node, node_fields in level:
+                for field, (many, child) in node.children.items():
+                    value = data.get(field)
+                    if not value or not wants_field(node_fields, field):
+                        continue
+                    subfields = get_subfields(node_fields, field)
+                    if many:
+                        data[field] = value = list(value)
+                        pending.extend((value, i, self.child_key(root_id, ref), root_id, child, subfields) for i, ref in enumerate(value))
+                    else:
+                        pending.append((data, field, self.child_key(root_id, value), root_id, child, subfields))
+            if not pending:
+                break
+
+            level = []
+            for (container, slot, _, root_id, child, subfields), value in zip(pending, get_values([p[2] for p in pending])):
+                # a missing list item becomes an empty object, a missing single child None
+                container[slot] = value if value is not None or not isinstance(slot, int) else {}
+                if value:
+                    level.append((value, root_id, child, subfields))
+        return roots
+
+    def assemble_documents(self, root: dict, get_children, fields=None, depth=2) -> dict:
+        # Rebuilds a plan from its ES documents, get_children(relation, parent id, routing)
+        # returns the child documents of one parent. The join field and content hash are dropped as each
+        # document is placed. Children past depth are returned as references, the same shape
+        # assemble returns from Redis, and missing single children become empty objects
+        root.pop("join_field", None)
+        root.pop("content_hash", None)
+        level = [(root, self.root, fields)]
+        for level_depth in range(depth + 1):
+            expand = level_depth < depth
+            next_level = []
+            for data, node, node_fields in level:
+                wanted = [
+                    (field, many, child, get_subfields(node_fields, field))
+                    for field, (many, child) in node.children.items() if wants_field(node_fields, field)
+                ]
+                if not wanted:
+                    continue
+
+                by_relation = {}
+                for document in get_children(node.relation, data["objectId"], root["objectId"]) or []:
+                    relation = document.pop("join_field", {}).get("name")
+                    document.pop("content_hash", None)
+                    by_relation.setdefault(relation, []).append(document)
+
+                for field, many, child, subfields in wanted:
+                    documents = by_relation.get(child.relation, [])
+                    if not expand:
+                        references = [get_reference(document) for document in documents]
+                        data[field] = references if many else (references[0] if references else None)
+                        continue
+                    data[field] = documents if many else (documents[0] if documents else {})
+                    next_level.extend((document, child, subfields) for document in documents[:None if many else 1])
+            level = next_level
+        return root
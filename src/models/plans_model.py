@@ -1,21 +1,118 @@
 import json
+import hashlib
+import time
+import logging
+from functools import cached_property, lru_cache
 from redis import Redis
 from src.models.elastic_search_model import ElasticSearchConfig
 from jsonschema import validate, ValidationError
 from src.models.redis_model import RedisModel
+from src.models.plan_graph import PlanGraph
 
-class PlanModel(RedisModel):
-    plan_schema = {}
+logger = logging.getLogger(__name__)
+
+@lru_cache(maxsize=None)
+def load_json_file(path: str) -> dict:
+    # read once per process on first use instead of at import
     try:
-        plan_schema = json.load(open("src/models/useCaseSchema.json"))
+        with open(path) as json_file:
+            return json.load(json_file)
     except Exception as e:
-        print(e)
+        logger.error("Could not load %s -> %s", path, e)
+        return {}
+
+class PlanModel(RedisModel):
+    CHANGE_STREAM = "plans:changes"
+    CHANGE_STREAM_MAXLEN = 1000000
+    CONTENT_HASHES = "plans:hashes"
+    # [_org, planType] of every aggregate group, totals summed per group
+    AGGREGATE_GROUPS = "aggregates:groups"
+    AGGREGATE_FIELDS = ("plans", "cost_shares", "deductible", "copays", "copay")
+    # seconds after which a pending aggregate change is taken as abandoned by its writer
+    AGGREGATE_REPLAY_AGE = 60
+    # KEYS: plan summary, pending changes of the plan
+    # ARGV: new summary or "" for a deleted plan, time of the change
+    # Swaps the summary and records [previous, new, time] until the group totals are moved
+    SWAP_AGGREGATES_SCRIPT = """
+    local previous = redis.call('GET', KEYS[1]) or ''
+    if ARGV[1] == '' then
+        redis.call('DEL', KEYS[1])
+    else
+        redis.call('SET', KEYS[1], ARGV[1])
+    end
+    local change = cjson.encode({previous, ARGV[1], tonumber(ARGV[2])})
+    redis.call('RPUSH', KEYS[2], change)
+    return change
+    """
+    # KEYS: plan key, member keys index, member documents index, then the change stream and
+    # the content hashes when they can be written with the plan (ARGV[1] is 2), child keys
+    # ARGV: number of those change keys, plan id, content hash, change stream max length,
+    # plan value, child values, then document id / routing pairs
+    CREATE_PLAN_SCRIPT = """
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        return 0
+    end
+    local first_child = 4 + tonumber(ARGV[1])
+    redis.call('SET', KEYS[1], ARGV[5])
+    for i = first_child, #KEYS do
+        redis.call('SET', KEYS[i], ARGV[i - first_child + 6])
+        redis.call('SADD', KEYS[2], KEYS[i])
+    end
+    for i = #KEYS - first_child + 7, #ARGV, 2 do
+        redis.call('HSET', KEYS[3], ARGV[i], ARGV[i + 1])
+    end
+    if first_child == 6 then
+        redis.call('HSET', KEYS[5], ARGV[2], ARGV[3])
+        redis.call('XADD', KEYS[4], 'MAXLEN', '~', ARGV[4], '*', 'action', 'create', 'plan_id', ARGV[2])
+    end
+    return 1
+    """
+
+    # linkedPlanService children -> their objectType
+    SERVICE_CHILDREN = {"linkedService": "service", "planserviceCostShares": "membercostshare"}
+    SEARCH_MAX_SIZE = 100
+    SEARCH_OPERATORS = ["gt", "gte", "lt", "lte"]
+    SEARCH_AGGREGATIONS = ["terms", "histogram", "stats"]
 
     def __init__(self, redis_client: Redis, es: ElasticSearchConfig):
         super().__init__(redis_client, "plan")
-        self.etag_model = RedisModel(redis_client, "etag")
         self.es = es
-        self.INDEX_NAME = "plans"
+        self.create_plan_script = redis_client.register_script(self.CREATE_PLAN_SCRIPT)
+        self.INDEX_NAME = es.INDEX_ALIAS
+
+    @property
+    def plan_schema(self) -> dict:
+        return load_json_file("src/models/useCaseSchema.json")
+
+    @property
+    def plan_mappings(self) -> dict:
+        return load_json_file("src/models/planMappings.json")
+
+    @cached_property
+    def join_relations(self) -> dict:
+        return self.plan_mappings.get("mappings", {}).get("properties", {}).get("join_field", {}).get("relations", {})
+
+    @cached_property
+    def join_parents(self) -> dict:
+        # child relation -> parent relation of the join field, e.g. linkedService -> linkedPlanService
+        return {child: parent for parent, children in self.join_relations.items() for child in children}
+
+    @cached_property
+    def join_types(self) -> set:
+        return set(self.join_relations.keys()) | set(self.join_parents.keys())
+
+    @cached_property
+    def plan_graph(self) -> PlanGraph:
+        return PlanGraph(self.plan_schema, self.plan_mappings, self.get_key, self.get_child_key)
+
+    @cached_property
+    def search_fields(self) -> dict:
+        # the join field and the content hash are bookkeeping, not plan data
+        properties = self.plan_mappings.get("mappings", {}).get("properties", {})
+        return {
+            name: value["type"] for name, value in properties.items()
+            if value["type"] != "join" and name != "content_hash"
+        }
 
     def validate_data(self, data):
         try:
@@ -27,82 +124,314 @@ class PlanModel(RedisModel):
         plan_data = plan
         self.validate_data(plan_data)
         plan_id = plan_data['objectId']
-        
-        if not self.get_plan(plan_id) or update:
-            elastic_conn = self.es.create_index if not update else self.es.update_index
-
-            updated_plan = {k: v for k, v in plan_data.items() if k not in ["planCostShares", "linkedPlanServices"]}
 
-            es_plan = updated_plan.copy()
-            es_plan["join_field"] = {"name": "plan"}  # Set join_field for parent document
-            elastic_conn(index=self.INDEX_NAME, id=plan_id, body=es_plan, doc_type="_doc")
-
-            # Store planCostShares in Redis and Elasticsearch
-            plan_cost_share_data = plan_data["planCostShares"].copy()
-            plan_cost_share_id = "{}:{}".format(plan_cost_share_data["objectType"], plan_cost_share_data["objectId"])
-            updated_plan["planCostShares"] = plan_cost_share_id
-            self.save(plan_cost_share_id, plan_cost_share_data)
-
-            plan_cost_share_data["join_field"] = {
-                "name": "planCostShare", 
-                "parent": plan_id  # Link to parent plan
-            }
-            elastic_conn(index=self.INDEX_NAME, id=plan_cost_share_data["objectId"], routing=plan_id, body=plan_cost_share_data, doc_type="_doc")
-
-            # Initialize the list for linkedPlanServices in the updated plan
-            updated_plan["linkedPlanServices"] = []
-            
-            for linked_service in plan_data["linkedPlanServices"]:
-                linked_plan_service_data = linked_service.copy()
-                linked_plan_service_id = linked_plan_service_data["objectId"]
-
-                # Index linkedPlanService in Elasticsearch
-                es_linked_plan_service = {k: v for k, v in linked_plan_service_data.items() if k not in ["linkedService", "planserviceCostShares"]}
-                es_linked_plan_service["join_field"] = {
-                    "name": "linkedPlanService", 
-                    "parent": plan_id  # Link to parent plan
-                }
-                elastic_conn(index=self.INDEX_NAME, id=linked_plan_service_id, routing=plan_id, body=es_linked_plan_service, doc_type="_doc")
-
-                # Store linkedService data
-                linked_service_data = linked_plan_service_data["linkedService"].copy()
-                linked_service_id = linked_service_data["objectId"]
-                linked_service_name = "{}:{}".format(linked_service_data["objectType"], linked_service_data["objectId"])
-                self.save(linked_service_name, linked_service_data)
+        # Redis is written first, in one round trip together with the change log entry and
+        # the content hash, and a create only goes ahead when the plan key does not exist yet
+        decomposition = self.decompose_plan(plan_data)
+        content_hash = self.get_content_hash(plan_data)
+        if not self.write_plan_graph(
+            plan_id, decomposition.records, decomposition.documents, create_only=not update,
+            change=("update" if update else "create", content_hash)
+        ):
+            return 0
+
+        # The children go in one bulk request. The plan document is written last and only
+        # carries the content hash when every child was written, so the reconciler can trust
+        # a matching hash
+        es_plan, *es_children = decomposition.actions
+        try:
+            _, errors = self.es.bulk_index(es_children)
+        except Exception as e:
+            logger.error("Could not index the documents of plan %s -> %s", plan_id, e)
+            errors = [e]
+        if not errors:
+            es_plan["_source"]["content_hash"] = content_hash
+        elastic_conn = self.es.create_index if not update else self.es.update_index
+        elastic_conn(index=self.INDEX_NAME, id=plan_id, body=es_plan["_source"], doc_type="_doc")
+        self.update_aggregates({plan_id: plan_data})
+        return 1
+
+    def get_child_key(self, plan_id, reference: str) -> str:
+        # plan:{<plan_id>}:<objectType>:<objectId>, children are stored per plan
+        return self.get_member_key(plan_id, reference)
+
+    def get_etag_key(self, plan_id, etag, weak=False) -> str:
+        # weak ETags are served for partial representations and never satisfy If-Match
+        return self.get_member_key(plan_id, "weak-etag" if weak else "etag", etag)
+
+    def decompose_plan(self, plan: dict, content_hash=None, with_records=True):
+        # stored Redis records, ES actions and member indexes of a complete plan, see PlanGraph
+        return self.plan_graph.decompose(plan, self.INDEX_NAME, content_hash, with_records)
+
+    def write_plan_graph(self, plan_id, records: dict, documents: list, create_only=False, change=None) -> bool:
+        # Writes the flattened plan and its member indexes, records must start with the plan key.
+        # change is the (action, content hash) logged for the reconciler in the same atomic
+        # step. On a cluster the change keys are in other slots, so it is logged just before
+        # and a crash can only leave an entry for a write that did not happen
+        plan_key, *child_keys = records
+        keys_index, documents_index = self.get_keys_index(plan_id), self.get_documents_index(plan_id)
+        document_args = [arg for document_id, routing in documents for arg in (document_id, routing or "")]
+        if change and self.cluster:
+            self.record_change(change[0], plan_id, content_hash=change[1])
+        logged = change and not self.cluster
+
+        if create_only:
+            change_keys = [self.CHANGE_STREAM, self.CONTENT_HASHES] if logged else []
+            created = self.create_plan_script(
+                keys=[plan_key, keys_index, documents_index, *change_keys, *child_keys],
+                args=[len(change_keys), plan_id, change[1] if change else "", self.CHANGE_STREAM_MAXLEN, *records.values(), *document_args]
+            )
+            return bool(created)
+
+        pipeline = self.redis_client.pipeline()
+        self.add_plan_graph(pipeline, plan_id, records, documents)
+        if logged:
+            self.queue_change(pipeline, change[0], plan_id, content_hash=change[1])
+        pipeline.execute()
+        return True
+
+    def add_plan_graph(self, pipeline, plan_id, records: dict, documents: list):
+        # queues the writes of one flattened plan, every key shares the plan's slot
+        # one SET per record, redis-py refuses MSET inside a cluster pipeline
+        child_keys = list(records)[1:]
+        for key, value in records.items():
+            pipeline.set(key, value)
+        if child_keys:
+            pipeline.sadd(self.get_keys_index(plan_id), *child_keys)
+        if documents:
+            pipeline.hset(self.get_documents_index(plan_id), mapping={
+                document_id: routing or "" for document_id, routing in documents
+            })
+
+    def write_plan_graphs(self, decompositions: dict, hashes: dict):
+        # Bulk load of plan_id -> Decomposition in one non transactional pipeline. Existing
+        # plans are replaced, the members they no longer have are deleted from both stores.
+        # hashes (plan_id -> content hash) and a change log entry per plan feed the reconciler
+        if not decompositions:
+            return
+        keys, documents = self.get_replaced_members(decompositions)
+        if documents:
+            self.es.bulk_operations(self.build_es_delete_actions(documents))
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.delete(key)
+        for plan_id, decomposition in decompositions.items():
+            self.add_plan_graph(pipeline, plan_id, decomposition.records, decomposition.documents)
+        pipeline.hset(self.CONTENT_HASHES, mapping=hashes)
+        for plan_id in decompositions:
+            self.add_change(pipeline, "update", plan_id)
+        pipeline.execute()
+
+    def get_replaced_members(self, decompositions: dict) -> tuple:
+        # (keys, documents) of the stored plans missing from their new decomposition, with
+        # the member indexes of those plans so that the write rebuilds them
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for plan_id in decompositions:
+            pipeline.smembers(self.get_keys_index(plan_id))
+            pipeline.hgetall(self.get_documents_index(plan_id))
+        results = pipeline.execute()
+
+        keys, documents = [], []
+        for (plan_id, decomposition), saved_keys, saved_documents in zip(decompositions.items(), results[::2], results[1::2]):
+            if not saved_keys and not saved_documents:
+                continue
+            document_ids = {document_id for document_id, _ in decomposition.documents}
+            keys += [key.decode("utf-8") for key in saved_keys if key.decode("utf-8") not in decomposition.records]
+            keys += [self.get_keys_index(plan_id), self.get_documents_index(plan_id)]
+            for document_id, routing in saved_documents.items():
+                document_id = document_id.decode("utf-8")
+                if document_id not in document_ids:
+                    documents.append([document_id, routing.decode("utf-8") or None])
+        return keys, documents
+
+    def get_content_hash(self, plan: dict) -> str:
+        return hashlib.sha1(json.dumps(plan, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+    def record_change(self, action, plan_id, content_hash=None, documents=None):
+        # Appends the mutation to the change log stream tailed by the reconciler and
+        # keeps the Redis side of the per-plan content hashes up to date
+        pipeline = self.redis_client.pipeline()
+        self.queue_change(pipeline, action, plan_id, content_hash, documents)
+        pipeline.execute()
+
+    def queue_change(self, pipeline, action, plan_id, content_hash=None, documents=None):
+        if content_hash:
+            pipeline.hset(self.CONTENT_HASHES, plan_id, content_hash)
+        elif action == "delete":
+            pipeline.hdel(self.CONTENT_HASHES, plan_id)
+        self.add_change(pipeline, action, plan_id, documents)
+
+    def add_change(self, pipeline, action, plan_id, documents=None):
+        entry = {"action": action, "plan_id": plan_id}
+        if documents is not None:
+            entry["documents"] = json.dumps(documents)
+        pipeline.xadd(self.CHANGE_STREAM, entry, maxlen=self.CHANGE_STREAM_MAXLEN, approximate=True)
+
+    def get_aggregates_key(self, plan_id) -> str:
+        # JSON cost share summary of the plan
+        return self.get_member_key(plan_id, "aggregates")
+
+    def get_pending_aggregates_key(self, plan_id) -> str:
+        # list of the plan's summary changes not yet applied to its group totals
+        return self.get_member_key(plan_id, "aggregates", "pending")
+
+    def get_group_key(self, org, plan_type) -> str:
+        # hash of the cost share totals of every plan of an _org and planType
+        return f"aggregates:{{{org}}}:{plan_type}"
+
+    def summarize_cost_shares(self, plan: dict) -> dict:
+        # totals of the plan cost shares and of every service cost share
+        cost_shares = [plan["planCostShares"]] if plan.get("planCostShares") else []
+        cost_shares += [
+            service["planserviceCostShares"] for service in plan.get("linkedPlanServices") or []
+            if service.get("planserviceCostShares")
+        ]
+        copays = [cost_share["copay"] for cost_share in cost_shares if cost_share.get("copay") is not None]
+        return {
+            "_org": plan.get("_org"),
+            "planType": plan.get("planType"),
+            "plans": 1,
+            "cost_shares": len(cost_shares),
+            "deductible": sum(cost_share.get("deductible", 0) for cost_share in cost_shares),
+            "copays": len(copays),
+            "copay": sum(copays)
+        }
 
-                linked_service_data["join_field"] = {
-                    "name": "linkedService", 
-                    "parent": linked_plan_service_id  # Link to linkedPlanService
-                }
-                elastic_conn(index=self.INDEX_NAME, id=linked_service_id, routing=linked_plan_service_id, body=linked_service_data, doc_type="_doc")
-                linked_plan_service_data["linkedService"] = linked_service_name
-
-                # Store planserviceCostShares data
-                planservice_cost_share_data = linked_plan_service_data["planserviceCostShares"].copy()
-                planservice_cost_share_id = planservice_cost_share_data["objectId"]
-                planservice_cost_share_name = "{}:{}".format(planservice_cost_share_data["objectType"], planservice_cost_share_id)
-                self.save(planservice_cost_share_name, planservice_cost_share_data)
-
-                planservice_cost_share_data["join_field"] = {
-                    "name": "planserviceCostShare", 
-                    "parent": linked_plan_service_id  # Link to linkedPlanService
-                }
-                elastic_conn(index=self.INDEX_NAME, id=planservice_cost_share_id, routing=linked_plan_service_id, body=planservice_cost_share_data, doc_type="_doc")
-                linked_plan_service_data["planserviceCostShares"] = planservice_cost_share_name
+    def update_aggregates(self, plans: dict):
+        # plan_id -> complete plan, None for a deleted plan. Every plan summary is swapped
+        # atomically with a record of the change, its group totals then move by the difference
+        # to the summary it replaced, so concurrent changes of one plan still add up. The group
+        # keys live in other slots, a change left pending by a crash is replayed later
+        now = time.time()
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for plan_id, plan in plans.items():
+            summary = json.dumps(self.summarize_cost_shares(plan)) if plan else ""
+            # EVAL sends the script with each call, a cluster pipeline cannot load it for EVALSHA
+            pipeline.eval(
+                self.SWAP_AGGREGATES_SCRIPT, 2,
+                self.get_aggregates_key(plan_id), self.get_pending_aggregates_key(plan_id), summary, now
+            )
+        changes = pipeline.execute()
+        self.apply_aggregate_changes({plan_id: [change] for plan_id, change in zip(plans, changes)})
+
+    def apply_aggregate_changes(self, changes: dict):
+        # plan_id -> pending changes, moves the group totals and drops the changes in one
+        # transaction, on a cluster the keys are in different slots and this is not atomic
+        deltas = {}
+        for plan_changes in changes.values():
+            for change in plan_changes:
+                previous, summary, _ = json.loads(change)
+                for totals, sign in ((previous, -1), (summary, 1)):
+                    if totals:
+                        totals = json.loads(totals)
+                        group = deltas.setdefault((totals["_org"], totals["planType"]), dict.fromkeys(self.AGGREGATE_FIELDS, 0))
+                        for field in self.AGGREGATE_FIELDS:
+                            group[field] += sign * totals[field]
+
+        pipeline = self.redis_client.pipeline(transaction=not self.cluster)
+        for (org, plan_type), group in deltas.items():
+            for field, delta in group.items():
+                if delta:
+                    pipeline.hincrbyfloat(self.get_group_key(org, plan_type), field, delta)
+            pipeline.sadd(self.AGGREGATE_GROUPS, json.dumps([org, plan_type]))
+        for plan_id, plan_changes in changes.items():
+            for change in plan_changes:
+                pipeline.lrem(self.get_pending_aggregates_key(plan_id), 1, change)
+        pipeline.execute()
+
+    def replay_aggregate_changes(self, min_age=None, count=1000) -> int:
+        # Applies the pending changes older than min_age seconds, returns how many. Younger
+        # ones may still be applied by their writer
+        min_age = self.AGGREGATE_REPLAY_AGE if min_age is None else min_age
+        match, prefix = self.get_pending_aggregates_key("*"), self.get_key("")[:-1]
+        replayed, cursor = 0, 0
+        while True:
+            cursor, keys = self.scan_page(cursor, match=match, count=count)
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for key in keys:
+                pipeline.lrange(key, 0, -1)
+            changes = {}
+            for key, plan_changes in zip(keys, pipeline.execute() if keys else []):
+                plan_changes = [change for change in plan_changes if time.time() - json.loads(change)[2] >= min_age]
+                if plan_changes:
+                    changes[key[len(prefix):key.rindex("}:")]] = plan_changes
+            if changes:
+                self.apply_aggregate_changes(changes)
+                replayed += sum(len(plan_changes) for plan_changes in changes.values())
+            if not cursor:
+                break
+        if replayed:
+            logger.warning("Replayed %s pending aggregate changes", replayed)
+        return replayed
+
+    def format_aggregates(self, totals: dict) -> dict:
+        # whole number totals as integers, with the average copay of the cost shares that have one
+        totals = {
+            field: int(value) if isinstance(value, float) and value.is_integer() else value
+            for field, value in totals.items()
+        }
+        totals["average_copay"] = round(totals["copay"] / totals["copays"], 2) if totals["copays"] else None
+        return totals
+
+    def get_plan_aggregates(self, plan_id):
+        summary = self.redis_client.get(self.get_aggregates_key(plan_id))
+        return self.format_aggregates(json.loads(summary)) if summary else None
+
+    def get_group_totals(self, groups: list) -> list:
+        # raw totals of [_org, planType] groups, None for groups without plans
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for org, plan_type in groups:
+            pipeline.hgetall(self.get_group_key(org, plan_type))
+        return [
+            {field.decode("utf-8"): float(value) for field, value in totals.items()} if totals and float(totals.get(b"plans", 0)) else None
+            for totals in pipeline.execute()
+        ]
 
-                # Save the updated linkedPlanService data
-                linked_plan_service_name = "{}:{}".format(linked_plan_service_data["objectType"], linked_plan_service_data["objectId"])
-                self.save(linked_plan_service_name, linked_plan_service_data)
-                updated_plan["linkedPlanServices"].append(linked_plan_service_name)
+    def get_aggregate_groups(self) -> list:
+        return [json.loads(group) for group in self.redis_client.smembers(self.AGGREGATE_GROUPS)]
+
+    def get_group_aggregates(self, org=None, plan_type=None) -> list:
+        # one HGETALL for a single _org and planType, otherwise every known group filtered
+        if org is not None and plan_type is not None:
+            groups = [[org, plan_type]]
+        else:
+            groups = [
+                group for group in self.get_aggregate_groups()
+                if (org is None or group[0] == org) and (plan_type is None or group[1] == plan_type)
+            ]
+        return [
+            {"_org": group[0], "planType": group[1], **self.format_aggregates(totals)}
+            for group, totals in zip(groups, self.get_group_totals(groups)) if totals
+        ]
 
-            # Save the updated plan in Redis and Elasticsearch
-            self.save(plan_id, updated_plan)
-            return 1
-        
-        return 0
-    
-    def create_etag(self, plan_id, etag):
-        return self.etag_model.save(f"{self.get_key(plan_id)}:{etag}", self.get_plan(plan_id))
+    def get_keys_index(self, plan_id) -> str:
+        # set of the Redis keys owned by the plan (children and etags)
+        return self.get_member_key(plan_id, "keys")
+
+    def get_documents_index(self, plan_id) -> str:
+        # hash of the ES document ids owned by the plan -> routing
+        return self.get_member_key(plan_id, "documents")
+
+    def get_plan_members(self, plan: dict):
+        # (child Redis keys, [id, routing] of ES documents) of a complete plan
+        decomposition = self.decompose_plan(plan, with_records=False)
+        return decomposition.keys, decomposition.documents
+
+    def get_saved_plan_members(self, plan_id):
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.smembers(self.get_keys_index(plan_id))
+        pipeline.hgetall(self.get_documents_index(plan_id))
+        keys, documents = pipeline.execute()
+        keys = [key.decode("utf-8") for key in keys]
+        documents = [[document_id.decode("utf-8"), routing.decode("utf-8") or None] for document_id, routing in documents.items()]
+        return keys, documents
+
+    def create_etag(self, plan_id, etag, weak=False, plan=None):
+        etag_key = self.get_etag_key(plan_id, etag, weak)
+        pipeline = self.redis_client.pipeline()
+        pipeline.sadd(self.get_keys_index(plan_id), etag_key)
+        pipeline.set(etag_key, json.dumps(self.get_plan(plan_id) if plan is None else plan))
+        pipeline.execute()
 
     def update_plan_partial(self, plan_id, update_data):
         plan_data = self.get_complete_plan(plan_id)
@@ -146,33 +475,91 @@ class PlanModel(RedisModel):
         #                 plan_data[key][idx] = temp_service
         return plan_data
     
-    def get_complete_plan(self, plan_id):
-        plan_data = self.get(plan_id)
-        if not plan_data:
+    def get_complete_plan(self, plan_id, fields=None, depth=2):
+        return self.get_complete_plans([plan_id], fields, depth)[0]
+
+    def parse_fields(self, fields_param: str) -> dict:
+        # "planType,linkedPlanServices.linkedService" -> {"planType": {}, "linkedPlanServices": {"linkedService": {}}}
+        if not fields_param:
             return None
-        
-        if plan_data["planCostShares"]:
-            plan_data["planCostShares"] = self.get(plan_data["planCostShares"])
-        
-        if plan_data["linkedPlanServices"]:
-            for idx, service_value in enumerate(plan_data["linkedPlanServices"]):
-                temp_service = self.get(service_value)
+        fields = {}
+        for path in fields_param.split(","):
+            node = fields
+            for name in path.strip().split("."):
+                if name:
+                    node = node.setdefault(name, {})
+        return fields
+
+    def project_fields(self, data, fields: dict):
+        # keeps the requested fields and the identity of every object
+        if fields is None:
+            return data
+        if isinstance(data, list):
+            return [self.project_fields(item, fields) for item in data]
+        if not isinstance(data, dict):
+            return data
+        return {
+            key: self.project_fields(value, fields.get(key) or None) for key, value in data.items()
+            if key in fields or key in ("objectId", "objectType")
+        }
 
-                if temp_service["linkedService"]:
-                    temp_service["linkedService"] = self.get(temp_service["linkedService"])
+    def assemble_plans(self, plans: list, fields=None, depth=2) -> list:
+        # Resolves the child references of many stored plans with one MGET per level.
+        # Subtrees outside depth (0 plan, 1 direct children, 2 everything) or fields are not fetched
+        return self.plan_graph.assemble([plan for plan in plans if plan], self.get_multiple_values, fields, depth)
+
+    def get_complete_plans(self, plan_ids: list, fields=None, depth=2) -> list:
+        # complete plans in the order of plan_ids, None for missing plans and for ids whose
+        # key holds something other than a plan
+        plans = [
+            plan if isinstance(plan, dict) and plan.get("objectType") == "plan" else None
+            for plan in self.get_many(plan_ids)
+        ]
+        self.assemble_plans(plans, fields, depth)
+        return [self.project_fields(plan, fields) if plan else None for plan in plans]
+
+    def scan_plans(self, cursor=0, count=1000):
+        # One SCAN page of complete plans, returns (next cursor, plans).
+        # Only plan:{<plan_id>} matches, member keys always continue after the hash tag
+        cursor, keys = self.scan_page(cursor, match=self.get_key("*"), count=count)
+        plans = [
+            plan for plan in self.get_multiple_values(keys)
+            if isinstance(plan, dict) and plan.get("objectType") == "plan"
+        ]
+        return cursor, self.assemble_plans(plans)
+
+    def bulk_index_plans(self, actions: dict, hashes: dict, chunk_size=1000) -> tuple:
+        # plan_id -> bulk actions of the plan without its content hash. The hash is set on the
+        # plan documents afterwards, only for plans whose documents were all written, so a
+        # matching hash always means a complete plan. Returns (written, errors, failed plan ids)
+        owners = {}
+        for plan_id, plan_actions in actions.items():
+            for action in plan_actions:
+                owners.setdefault(action["_id"], set()).add(plan_id)
+        success, errors = self.es.bulk_index(
+            [action for plan_actions in actions.values() for action in plan_actions], chunk_size=chunk_size
+        )
+        failed = set()
+        for error in errors:
+            failed |= owners.get(next(iter(error.values())).get("_id"), set())
+
+        hash_actions = [
+            {"_op_type": "update", "_index": self.INDEX_NAME, "_id": plan_id, "doc": {"content_hash": hashes[plan_id]}}
+            for plan_id in actions if plan_id not in failed
+        ]
+        _, hash_errors = self.es.bulk_index(hash_actions, chunk_size=chunk_size)
+        failed |= {next(iter(error.values())).get("_id") for error in hash_errors}
+        return success, errors + hash_errors, failed
+
+    def build_es_actions(self, plan: dict, content_hash=None) -> list:
+        # bulk index actions for a complete plan, same documents and routing as create_plan
+        return self.decompose_plan(plan, content_hash, with_records=False).actions
 
-                if temp_service["planserviceCostShares"]:
-                    temp_service["planserviceCostShares"] = self.get(temp_service["planserviceCostShares"])
-                
-                plan_data["linkedPlanServices"][idx] = temp_service
-        
-        return plan_data
-    
     def remove_join_field(self, obj):
         if isinstance(obj, dict):
-            # Remove 'join_field' key if present
-            if 'join_field' in obj:
-                del obj['join_field']
+            # Remove 'join_field' and 'content_hash' keys if present
+            obj.pop('join_field', None)
+            obj.pop('content_hash', None)
             
             # Recursively process dictionary values
             for key in list(obj.keys()):
@@ -200,7 +587,8 @@ class PlanModel(RedisModel):
 
         return self.check_es_hits(self.es.search_index(index=self.INDEX_NAME, body=query))
     
-    def get_es_children(self, parent_type: str, parent_id: str):
+    def get_es_children(self, parent_type: str, parent_id: str, routing=None):
+        # routing is the id of the plan the parent belongs to, every shard is searched without it
         query = {
             "query": {
                 "has_parent": {
@@ -214,80 +602,184 @@ class PlanModel(RedisModel):
             }
         }
 
-        return self.check_es_hits(self.es.search_index(index=self.INDEX_NAME, routing=parent_id, body=query))
+        return self.check_es_hits(self.es.search_index(index=self.INDEX_NAME, routing=routing, body=query))
 
-    def get_complete_plan_es(self, plan_id):
+    def get_complete_plan_es(self, plan_id, fields=None, depth=2):
         # Fetch plan from ES
         plan_result = self.get_es_plan(plan_id)
 
         # Check if plan is found
         if not plan_result:
             return None
-        plan_data = plan_result[0]
-
-        # Get plan children from ES
-        children_data = self.get_es_children("plan", plan_id)
-        
-        # Get planCostShare and linkedPlanService from children result
-        plan_cost_share_data = list(filter(lambda d: d['objectType'] == "membercostshare", children_data))[0] or {}
-        linked_plan_service_data = list(filter(lambda d: d['objectType'] == "planservice", children_data)) or []
-
-
-        # Iterate over linked_plan_service_data
-        for idx, linked_service in enumerate(linked_plan_service_data):
-            linked_service_id = linked_service["objectId"]
-
-            # Get linkedPlanService children from ES
-            linked_service_children_result = self.get_es_children("linkedPlanService", linked_service_id)
-            
-            # Get planCostShare and linkedService objects from linked service children
-            linked_plan_service_data[idx]["linkedService"] = list(filter(lambda d: d['objectType'] == "service", linked_service_children_result))[0] or {}
-            linked_plan_service_data[idx]["planserviceCostShares"] = list(filter(lambda d: d['objectType'] == "membercostshare", linked_service_children_result))[0] or {}
-
-        
-        plan_data["planCostShares"] = plan_cost_share_data
-        plan_data["linkedPlanServices"] = linked_plan_service_data
 
-        self.remove_join_field(plan_data)
-
-        return plan_data
+        # Same projection as assemble_plans, children outside it are not searched for
+        plan_data = self.plan_graph.assemble_documents(plan_result[0], self.get_es_children, fields, depth)
+        return self.project_fields(plan_data, fields)
 
     def get_multiple_plans(self) -> list:
-        keys = self.get_multiple_keys(self.key_prefix)
-        return self.get_multiple_values(keys)
+        # plan:{<plan_id>} keys only, child, etag and member index keys continue after the hash tag
+        keys = self.get_multiple_keys(self.get_key("*"))
+        return [plan for plan in self.get_multiple_values(keys) if plan]
 
     def delete_plan_etag(self, plan_id, delete_plan=True):
-        plan = self.get_key(plan_id)
-        keys = [plan] if delete_plan else []
-        keys.extend(self.get_multiple_keys(f"{self.etag_model.key_prefix}:{plan}:*"))
-        keys.extend(self.get_multiple_keys(f"{plan}:*"))
-
-        plan_data = self.get(plan_id)
-        es_ids = [
-            {"delete": {"_index": self.INDEX_NAME, "_id": plan_data["objectId"]}}
-        ]
-
-        plan_cost_share_id = plan_data["planCostShares"].split(":")[1]
-        es_ids.append({"delete": {"_index": self.INDEX_NAME, "_id": plan_cost_share_id}})
-        keys.extend([self.get_key(plan_data["planCostShares"])])
-
-        for service in (plan_data["linkedPlanServices"] or []):
-            service_id = service.split(":")[1]
-            
-            linked_service_data = self.get(service)
-            linked_service_id = linked_service_data["linkedService"].split(":")[1]
-            es_ids.append({"delete": {"_index": self.INDEX_NAME, "_id": linked_service_id}})
-            
-            plan_service_cost_shares = linked_service_data["planserviceCostShares"].split(":")[1]
-            es_ids.append({"delete": {"_index": self.INDEX_NAME, "_id": plan_service_cost_shares}})
-            
-            keys.extend([self.get_key(service), self.get_key(linked_service_data["linkedService"]), self.get_key(linked_service_data["planserviceCostShares"])])
-            es_ids.append({"delete": {"_index": self.INDEX_NAME, "_id": service_id}})
-        
-        self.es.bulk_operations(es_ids)
+        keys, documents = self.get_saved_plan_members(plan_id)
+        if not documents:
+            # plans saved before the member index existed, their etag keys are not tracked
+            plan_data = self.get_complete_plans([plan_id])[0]
+            if not plan_data:
+                return 0
+            keys, documents = self.get_plan_members(plan_data)
+
+        # Redis and the change log go first, in one transaction, so that ES is repaired by the
+        # reconciler whatever happens afterwards. Keeping the plan key is the first half of an
+        # update, its entry covers the children removed until the update is written
+        keys.extend([self.get_keys_index(plan_id), self.get_documents_index(plan_id)])
+        if delete_plan:
+            keys.append(self.get_key(plan_id))
+        action, change_documents = ("delete", documents) if delete_plan else ("update", None)
+        if self.cluster:
+            # the change keys are in other slots, the entry is logged just before
+            self.record_change(action, plan_id, documents=change_documents)
+            deleted = self.delete_multiple_keys(keys)
+        else:
+            pipeline = self.redis_client.pipeline()
+            pipeline.delete(*keys)
+            self.queue_change(pipeline, action, plan_id, documents=change_documents)
+            deleted = pipeline.execute()[0]
+
+        self.es.bulk_operations(self.build_es_delete_actions(documents))
+        if delete_plan:
+            self.update_aggregates({plan_id: None})
+        return deleted
+
+    def build_plan_documents_query(self, plan_ids: list) -> dict:
+        # every document of the given plans, used when the document ids are no longer known
+        plans_query = {"ids": {"values": plan_ids}}
+        return {
+            "bool": {
+                "should": [
+                    plans_query,
+                    {"has_parent": {"parent_type": "plan", "query": plans_query}},
+                    {"has_parent": {
+                        "parent_type": "linkedPlanService",
+                        "query": {"has_parent": {"parent_type": "plan", "query": plans_query}}
+                    }}
+                ]
+            }
+        }
 
-        return self.delete_multiple_keys(keys)
+    def build_es_delete_actions(self, documents: list) -> list:
+        actions = []
+        for document_id, routing in documents:
+            action = {"_index": self.INDEX_NAME, "_id": document_id}
+            if routing:
+                action["routing"] = routing
+            actions.append({"delete": action})
+        return actions
     
-    def check_etag_exists(self, etag):
-        return self.etag_model.get_multiple_keys(f"*:{etag}")
-        # return self.etag_model.get_multiple_keys(f"{self.etag_model.key_prefix}:*:{etag}")
+    def check_etag_exists(self, plan_id, etag, weak=False):
+        # weak comparison (If-None-Match) accepts both kinds, strong comparison (If-Match) only
+        # ETags of complete plans
+        if weak:
+            return self.redis_client.exists(self.get_etag_key(plan_id, etag), self.get_etag_key(plan_id, etag, True))
+        return self.redis_client.exists(self.get_etag_key(plan_id, etag))
+
+    def get_join_ancestors(self, join_type: str) -> list:
+        ancestors = []
+        while join_type in self.join_parents:
+            join_type = self.join_parents[join_type]
+            ancestors.append(join_type)
+        return ancestors
+
+    def build_search_value(self, field: str, value: str):
+        if self.search_fields[field] == "integer":
+            try:
+                return int(value)
+            except ValueError:
+                raise ValueError(f"Invalid value for {field}: {value}")
+        return value
+
+    def build_search_clause(self, field: str, operator: str, value: str) -> dict:
+        if field not in self.search_fields:
+            raise ValueError(f"Unknown search field: {field}")
+        if operator == "eq":
+            return {"term": {field: self.build_search_value(field, value)}}
+        if operator not in self.SEARCH_OPERATORS:
+            raise ValueError(f"Unknown search operator: {operator}")
+        return {"range": {field: {operator: self.build_search_value(field, value)}}}
+
+    def wrap_join_query(self, doc_type: str, filter_type: str, query: dict) -> dict:
+        # Walks the join tree from the filtered relation to the returned relation,
+        # wrapping the query in has_child (going down) and has_parent (going up)
+        doc_path = [doc_type] + self.get_join_ancestors(doc_type)
+        filter_path = [filter_type] + self.get_join_ancestors(filter_type)
+        common = next(join_type for join_type in doc_path if join_type in filter_path)
+
+        for join_type in filter_path[:filter_path.index(common)]:
+            query = {"has_child": {"type": join_type, "query": query}}
+        for join_type in reversed(doc_path[1:doc_path.index(common) + 1]):
+            query = {"has_parent": {"parent_type": join_type, "query": query}}
+        return query
+
+    def build_search_query(self, doc_type: str, filters: list) -> dict:
+        # filters are (join type, field, operator, value) tuples
+        if doc_type not in self.join_types:
+            raise ValueError(f"Unknown document type: {doc_type}")
+
+        clauses = {}
+        for filter_type, field, operator, value in filters:
+            filter_type = filter_type or doc_type
+            if filter_type not in self.join_types:
+                raise ValueError(f"Unknown document type: {filter_type}")
+            clauses.setdefault(filter_type, []).append(self.build_search_clause(field, operator, value))
+
+        query_filter = [{"term": {"join_field": doc_type}}]
+        for filter_type, filter_clauses in clauses.items():
+            query_filter.append(self.wrap_join_query(doc_type, filter_type, {"bool": {"filter": filter_clauses}}))
+
+        return {"bool": {"filter": query_filter}}
+
+    def build_search_aggregations(self, aggregations: list) -> dict:
+        # aggregations are "terms:<field>", "stats:<field>" or "histogram:<field>:<interval>"
+        aggs = {}
+        for aggregation in aggregations:
+            kind, _, params = aggregation.partition(":")
+            field, _, interval = params.partition(":")
+            if kind not in self.SEARCH_AGGREGATIONS:
+                raise ValueError(f"Unknown aggregation: {kind}")
+            if field not in self.search_fields:
+                raise ValueError(f"Unknown aggregation field: {field}")
+
+            if kind == "histogram":
+                if self.search_fields[field] != "integer" or not interval.isdigit() or int(interval) <= 0:
+                    raise ValueError(f"Invalid histogram aggregation: {aggregation}")
+                aggs[f"{kind}_{field}"] = {"histogram": {"field": field, "interval": int(interval)}}
+            else:
+                aggs[f"{kind}_{field}"] = {kind: {"field": field}}
+        return aggs
+
+    def search_plans(self, doc_type="plan", filters=None, size=20, search_after=None, aggregations=None):
+        size = min(max(int(size), 0), self.SEARCH_MAX_SIZE)
+        body = {
+            "query": self.build_search_query(doc_type, filters or []),
+            "size": size,
+            "sort": [{"objectId": "asc"}]
+        }
+        if search_after:
+            body["search_after"] = [search_after]
+        if aggregations:
+            body["aggs"] = self.build_search_aggregations(aggregations)
+
+        data = self.es.search_index(index=self.INDEX_NAME, body=body)
+        if data is None:
+            raise RuntimeError("Search failed")
+
+        hits = data["hits"]["hits"]
+        documents = [value["_source"] for value in hits]
+        self.remove_join_field(documents)
+        return {
+            "total": data["hits"]["total"]["value"],
+            "hits": documents,
+            "search_after": hits[-1]["sort"][0] if len(hits) == size and hits else None,
+            "aggregations": data.get("aggregations", {})
+        }
@@ -0,0 +1,97 @@
+import json
+import os
+import time
+import threading
+import logging
+import pika
+from pika.exceptions import AMQPError
+
+logger = logging.getLogger(__name__)
+
+class QueueModel:
+    # Publishes plan mutations to RabbitMQ. The connection is opened on first use in
+    # each process, workers forked by a pre-fork server never share the parent's socket
+    # hash with the lag of the last message the consumer applied and when it did
+    CONSUMER_STATS = "plans:consumer"
+
+    def __init__(self, host: str, queue: str = "plans", redis_client=None, stats_ttl: float = 1.0):
+        self.host = host
+        self.queue = queue
+        self.redis_client = redis_client
+        self.stats_ttl = stats_ttl
+        self.backlog = None
+        self.backlog_checked = 0.0
+        self.connection = None
+        self.channel = None
+        self.pid = None
+        self.lock = threading.Lock()
+        os.register_at_fork(after_in_child=self.reset_connection)
+
+    def reset_connection(self):
+        # the parent's socket is left alone, the child connects again on first use
+        self.lock = threading.Lock()
+        self.connection = None
+        self.channel = None
+
+    def get_channel(self):
+        if self.channel is None or self.pid != os.getpid() or not self.channel.is_open:
+            self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
+            self.channel = self.connection.channel()
+            self.channel.queue_declare(queue=self.queue)
+            self.pid = os.getpid()
+            logger.info("Connected to RabbitMQ in process %s", self.pid)
+        return self.channel
+
+    def publish(self, message: dict):
+        body = json.dumps({**message, "published_at": time.time()})
+        # a blocking connection is not thread safe, threaded workers publish one at a time
+        with self.lock:
+            try:
+                self.get_channel().basic_publish(exchange='', routing_key=self.queue, body=body)
+            except AMQPError as e:
+                # idle connections miss heartbeats and are closed by the broker, retry once
+                logger.warning("RabbitMQ publish failed, reconnecting -> %s", e)
+                self.channel = None
+                self.get_channel().basic_publish(exchange='', routing_key=self.queue, body=body)
+
+    def record_lag(self, published_at: float):
+        # called by the consumer after applying a message
+        now = time.time()
+        self.redis_client.hset(self.CONSUMER_STATS, mapping={"lag": max(now - published_at, 0), "updated_at": now})
+
+    def get_backlog(self) -> dict:
+        # {"depth", "consumers", "lag"} of the queue, cached for stats_ttl seconds so
+        # admission control costs one passive declare per process and interval
+        if self.backlog and time.monotonic() - self.backlog_checked < self.stats_ttl:
+            return self.backlog
+
+        with self.lock:
+            declared = self.get_channel().queue_declare(queue=self.queue, passive=True)
+        depth, consumers = declared.method.message_count, declared.method.consumer_count
+
+        # the recorded lag only matters while messages are waiting, a consumer that
+        # went away is as late as its last update
+        lag = 0.0
+        stats = self.redis_client.hgetall(self.CONSUMER_STATS) if self.redis_client and depth else {}
+        if stats:
+            lag = float(stats[b"lag"])
+            if not consumers:
+                lag = max(lag, time.time() - float(stats[b"updated_at"]))
+
+        self.backlog = {"depth": depth, "consumers": consumers, "lag": round(lag, 3)}
+        self.backlog_checked = time.monotonic()
+        return self.backlog
+
+    def check(self) -> bool:
+        # readiness check, also services heartbeats of an otherwise idle connection
+        with self.lock:
+            self.get_channel()
+            self.connection.process_data_events(time_limit=0)
+            return self.channel.is_open
+
+    def close(self):
+        with self.lock:
+            if self.connection and self.pid == os.getpid() and self.connection.is_open:
+                self.connection.close()
+            self.connection = None
+            self.channel = None
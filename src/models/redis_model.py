@@ -1,52 +1,120 @@
 import json
 import logging
+import os
+import threading
 from redis import Redis
+from redis.cluster import RedisCluster
+from redis.commands.core import Script
+from redis.connection import Encoder
 
 logger = logging.getLogger(__name__)
 
+class LazyRedis:
+    # Stands in for a Redis or RedisCluster client created on first use in each process,
+    # a cluster client contacts its startup node as soon as it is constructed
+    def __init__(self, create_client, cluster=False):
+        self.create_client = create_client
+        self.is_cluster = cluster
+        self._client = None
+        self._client_pid = None
+        self._client_lock = threading.Lock()
+        os.register_at_fork(after_in_child=self.reset_client)
+
+    def reset_client(self):
+        # the lock may have been held by another thread of the parent at fork time
+        self._client_lock = threading.Lock()
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None or self._client_pid != os.getpid():
+            with self._client_lock:
+                if self._client is None or self._client_pid != os.getpid():
+                    self._client = self.create_client()
+                    self._client_pid = os.getpid()
+        return self._client
+
+    def get_encoder(self):
+        # the default encoder of both clients, scripts are hashed without connecting
+        return Encoder(encoding="utf-8", encoding_errors="strict", decode_responses=False)
+
+    def register_script(self, script):
+        # the script runs through this proxy, so registering it does not create the client
+        return Script(self, script)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
 class RedisModel:
     def __init__(self, redis_client: Redis, key_prefix: str):
         self.redis_client = redis_client
         self.key_prefix = key_prefix
+        self.cluster = redis_client.is_cluster if isinstance(redis_client, LazyRedis) else isinstance(redis_client, RedisCluster)
 
     def get_key(self, id):
-        # return f"{self.key_prefix}:{id}"
-        return f"{id}"
+        # the id is the hash tag, so every key built on it with get_member_key
+        # lives in the same Redis Cluster slot
+        return f"{self.key_prefix}:{{{id}}}"
+
+    def get_member_key(self, id, *parts):
+        return ":".join([self.get_key(id), *parts])
 
     def save(self, id, data):
         key = self.get_key(id)
         self.redis_client.set(key, json.dumps(data))
-        logger.info("Save data to redis - {}".format(key))
+        logger.debug("Save data to redis - %s", key)
 
     def get(self, id):
         key = self.get_key(id)
         data = self.redis_client.get(key)
         if data:
-            logger.info("Fetched data from redis - {}".format(key))
+            logger.debug("Fetched data from redis - %s", key)
             return json.loads(data)
-        logger.info("Failed to get data from redis - {}".format(key))
+        logger.debug("Failed to get data from redis - %s", key)
         return 0
     
-    def get_multiple_keys(self, regexp) -> list:
-        _, keys = self.redis_client.scan(match=f"{regexp}*")
-        keys = [key.decode("utf-8") for key in keys]
-        return keys
+    def get_multiple_keys(self, match) -> list:
+        return [key.decode("utf-8") for key in self.redis_client.scan_iter(match=match, count=1000)]
     
+    def scan_page(self, cursor=0, match=None, count=1000):
+        # single SCAN call, returns (next cursor, keys), the scan is complete when the cursor is 0
+        if not self.cluster:
+            cursor, keys = self.redis_client.scan(cursor=cursor, match=match, count=count)
+            return int(cursor), [key.decode("utf-8") for key in keys]
+
+        # On a cluster the primaries are scanned one after another, the cursor packs
+        # the node position and that node's own cursor so it can still be checkpointed
+        nodes = sorted(self.redis_client.get_primaries(), key=lambda node: node.name)
+        node_index, node_cursor = cursor % len(nodes), cursor // len(nodes)
+        node = nodes[node_index]
+        cursors, keys = self.redis_client.scan(cursor=node_cursor, match=match, count=count, target_nodes=node)
+        node_cursor = int(cursors[node.name])
+        if node_cursor:
+            cursor = node_cursor * len(nodes) + node_index
+        else:
+            cursor = node_index + 1 if node_index + 1 < len(nodes) else 0
+        return cursor, [key.decode("utf-8") for key in keys]
+
     def get_multiple_values(self, keys) -> list:
-        data = self.redis_client.mget(keys)
-        data = [json.loads(d.decode("utf-8")) for d in data]
-        return data
+        # MGET that keeps the position of missing keys as None, split per slot on a cluster
+        if not keys:
+            return []
+        data = self.redis_client.mget_nonatomic(keys) if self.cluster else self.redis_client.mget(keys)
+        return [json.loads(d) if d else None for d in data]
     
+    def get_many(self, ids) -> list:
+        return self.get_multiple_values([self.get_key(id) for id in ids])
+
     def delete_multiple_keys(self, keys) -> int:
         return self.redis_client.delete(*keys) if keys else 0
     
     def check_key_exists(self, id) -> int:
         key = self.get_key(id)
-        logger.info("Check key exists in redis - {}".format(key))
+        logger.debug("Check key exists in redis - %s", key)
         return self.redis_client.exists(key)
 
     def delete(self, id):
         key = self.get_key(id)
         val = self.redis_client.delete(key)
-        logger.info("Key deleted from redis - {}".format(key))
+        logger.debug("Key deleted from redis - %s", key)
         return val
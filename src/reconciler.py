@@ -0,0 +1,239 @@
+import argparse
+import json
+import os
+import socket
+import time
+import logging
+from redis.exceptions import ResponseError
+from elasticsearch.exceptions import TransportError
+from src import plan_model, es_config
+
+logger = logging.getLogger(__name__)
+
+class PlanReconciler:
+    GROUP = "es-reconciler"
+    # seconds to wait after a failed batch, doubled up to the max while ES stays down
+    BACKOFF_MIN = 1.0
+    BACKOFF_MAX = 60.0
+
+    def __init__(self, consumer_name=None, batch_size=500, block_ms=5000, min_idle_ms=60000, check_interval=3600):
+        self.redis_client = plan_model.redis_client
+        self.consumer_name = consumer_name or "{}-{}".format(socket.gethostname(), os.getpid())
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.min_idle_ms = min_idle_ms
+        self.check_interval = check_interval
+        self.running = False
+
+    def create_group(self):
+        try:
+            self.redis_client.xgroup_create(plan_model.CHANGE_STREAM, self.GROUP, id="0", mkstream=True)
+            logger.info("Created consumer group %s", self.GROUP)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read_changes(self) -> list:
+        # changes left pending by a crashed or failed run are claimed first, then new ones are read
+        claimed = self.redis_client.xautoclaim(
+            plan_model.CHANGE_STREAM, self.GROUP, self.consumer_name,
+            min_idle_time=self.min_idle_ms, start_id="0-0", count=self.batch_size
+        )
+        entries = claimed[1]
+        if not entries:
+            response = self.redis_client.xreadgroup(
+                self.GROUP, self.consumer_name, {plan_model.CHANGE_STREAM: ">"},
+                count=self.batch_size, block=self.block_ms
+            )
+            entries = response[0][1] if response else []
+        return entries
+
+    def process(self, entries: list):
+        latest = {}
+        entry_ids = {}
+        trimmed = []
+        for entry_id, fields in entries:
+            if not fields:
+                # trimmed from the stream while pending
+                trimmed.append(entry_id)
+                continue
+            fields = {key.decode("utf-8"): value.decode("utf-8") for key, value in fields.items()}
+            latest[fields["plan_id"]] = fields
+            entry_ids.setdefault(fields["plan_id"], []).append(entry_id)
+
+        failed = self.apply(latest)
+        ack_ids = trimmed + [
+            entry_id for plan_id, ids in entry_ids.items() if plan_id not in failed for entry_id in ids
+        ]
+        if ack_ids:
+            self.redis_client.xack(plan_model.CHANGE_STREAM, self.GROUP, *ack_ids)
+        logger.info("Reconciled %s plans, %s left pending", len(entry_ids) - len(failed), len(failed))
+
+    def apply(self, latest: dict) -> set:
+        # Brings ES in line with Redis for the changed plans, returns the plan ids that failed
+        upserts = [plan_id for plan_id, fields in latest.items() if fields["action"] != "delete"]
+        plans = dict(zip(upserts, plan_model.get_complete_plans(upserts)))
+        deletes = {
+            plan_id: json.loads(fields["documents"]) for plan_id, fields in latest.items()
+            if fields["action"] == "delete" and fields.get("documents")
+        }
+        orphans = [plan_id for plan_id in latest if plan_id not in deletes and not plans.get(plan_id)]
+
+        hashes = {plan_id: plan_model.get_content_hash(plan) for plan_id, plan in plans.items() if plan}
+        es_hashes = es_config.get_documents(list(hashes), _source_includes=["content_hash"])
+        stale = [plan_id for plan_id, content_hash in hashes.items() if es_hashes.get(plan_id, {}).get("content_hash") != content_hash]
+        if hashes:
+            self.redis_client.hset(plan_model.CONTENT_HASHES, mapping=hashes)
+
+        owners = {}
+        actions = []
+        for plan_id in stale:
+            for action in plan_model.build_es_actions(plans[plan_id]):
+                owners.setdefault(action["_id"], set()).add(plan_id)
+                actions.append(action)
+        for plan_id, documents in deletes.items():
+            # streaming_bulk takes the operation as _op_type, not as a raw bulk header
+            for document_id, routing in documents:
+                action = {"_op_type": "delete", "_index": plan_model.INDEX_NAME, "_id": document_id}
+                if routing:
+                    action["_routing"] = routing
+                owners.setdefault(document_id, set()).add(plan_id)
+                actions.append(action)
+
+        failed = set()
+        _, errors = es_config.bulk_index(actions)
+        for error in errors:
+            op_type, result = next(iter(error.items()))
+            if op_type == "delete" and result.get("status") == 404:
+                continue
+            logger.error("Failed to reconcile document -> %s", result)
+            failed |= owners.get(result.get("_id"), set())
+
+        # the hash is only set once all documents of a plan are written, see create_plan
+        hash_actions = [
+            {"_op_type": "update", "_index": plan_model.INDEX_NAME, "_id": plan_id, "doc": {"content_hash": hashes[plan_id]}}
+            for plan_id in stale if plan_id not in failed
+        ]
+        _, errors = es_config.bulk_index(hash_actions)
+        failed |= {next(iter(error.values())).get("_id") for error in errors}
+
+        if orphans:
+            try:
+                es_config.delete_by_query(plan_model.build_plan_documents_query(orphans))
+            except Exception as e:
+                logger.error(str(e))
+                failed |= set(orphans)
+        return failed
+
+    def check_divergence(self) -> int:
+        # Compares the per-plan content hashes of both stores and queues the differences
+        diverged = set()
+
+        cursor = 0
+        while True:
+            cursor, hashes = self.redis_client.hscan(plan_model.CONTENT_HASHES, cursor, count=1000)
+            hashes = {key.decode("utf-8"): value.decode("utf-8") for key, value in hashes.items()}
+            es_hashes = es_config.get_documents(list(hashes), _source_includes=["content_hash"])
+            diverged.update(
+                plan_id for plan_id, content_hash in hashes.items()
+                if es_hashes.get(plan_id, {}).get("content_hash") != content_hash
+            )
+            if not cursor:
+                break
+
+        search_after = None
+        while True:
+            body = {"query": {"term": {"join_field": "plan"}}, "size": 1000, "sort": [{"objectId": "asc"}], "_source": False}
+            if search_after:
+                body["search_after"] = search_after
+            data = es_config.search_index(index=plan_model.INDEX_NAME, body=body)
+            if data is None:
+                raise RuntimeError("Search failed")
+            hits = data["hits"]["hits"]
+            if not hits:
+                break
+            plan_ids = [hit["_id"] for hit in hits]
+            redis_hashes = self.redis_client.hmget(plan_model.CONTENT_HASHES, plan_ids)
+            diverged.update(plan_id for plan_id, content_hash in zip(plan_ids, redis_hashes) if content_hash is None)
+            search_after = hits[-1]["sort"]
+
+        for plan_id in diverged:
+            plan_model.record_change("reconcile", plan_id)
+        logger.info("Divergence check queued %s plans", len(diverged))
+        return len(diverged)
+
+    def get_last_change_id(self) -> str:
+        entries = self.redis_client.xrevrange(plan_model.CHANGE_STREAM, count=1)
+        return entries[0][0].decode("utf-8") if entries else "0-0"
+
+    def requeue_changes(self, since_id: str) -> int:
+        # Queues every plan changed after since_id again, e.g. once ES was restored or an index
+        # swapped. Falls back to a divergence check when the stream was trimmed past since_id
+        def stream_id(entry_id: str) -> tuple:
+            return tuple(int(part) for part in entry_id.split("-"))
+
+        first = self.redis_client.xrange(plan_model.CHANGE_STREAM, count=1)
+        if first and since_id != "0-0" and stream_id(first[0][0].decode("utf-8")) > stream_id(since_id):
+            logger.warning("Change log trimmed past %s, checking every plan", since_id)
+            return self.check_divergence()
+
+        plan_ids, start = set(), "(" + since_id
+        while True:
+            entries = self.redis_client.xrange(plan_model.CHANGE_STREAM, min=start, count=self.batch_size)
+            if not entries:
+                break
+            plan_ids.update(fields[b"plan_id"].decode("utf-8") for _, fields in entries)
+            start = "(" + entries[-1][0].decode("utf-8")
+
+        for plan_id in plan_ids:
+            plan_model.record_change("reconcile", plan_id)
+        logger.info("Requeued %s plans changed since %s", len(plan_ids), since_id)
+        return len(plan_ids)
+
+    def run(self):
+        self.create_group()
+        self.running = True
+        last_check = time.monotonic()
+        backoff = self.BACKOFF_MIN
+        logger.info("Reconciler %s is ready", self.consumer_name)
+
+        while self.running:
+            entries = self.read_changes()
+            try:
+                if entries:
+                    self.process(entries)
+                if self.check_interval and time.monotonic() - last_check >= self.check_interval:
+                    last_check = time.monotonic()
+                    self.check_divergence()
+                    plan_model.replay_aggregate_changes()
+                backoff = self.BACKOFF_MIN
+            except (TransportError, RuntimeError) as e:
+                # the batch is left unacknowledged and claimed again once it is idle for min_idle_ms
+                logger.error("ElasticSearch unavailable, retrying in %ss -> %s", backoff, e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.BACKOFF_MAX)
+
+    def stop(self):
+        self.running = False
+
+# Usage: python -m src.reconciler [--check-interval 3600] [--check-only]
+def main():
+    parser = argparse.ArgumentParser(description="Tail the plan change log and re-apply changes to Elasticsearch")
+    parser.add_argument("--batch-size", type=int, default=500, help="change log entries per bulk request")
+    parser.add_argument("--min-idle-ms", type=int, default=60000, help="idle time before pending changes are retried")
+    parser.add_argument("--check-interval", type=int, default=3600, help="seconds between divergence checks, 0 disables them")
+    parser.add_argument("--check-only", action="store_true", help="run one divergence check and exit")
+    args = parser.parse_args()
+
+    reconciler = PlanReconciler(batch_size=args.batch_size, min_idle_ms=args.min_idle_ms, check_interval=args.check_interval)
+    if args.check_only:
+        print("Queued {} diverged plans".format(reconciler.check_divergence()))
+        return
+
+    try:
+        reconciler.run()
+    except KeyboardInterrupt:
+        reconciler.stop()
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
 from flask import request, Response, Blueprint
 from src.controllers.plans_controller import plans
-from src import config
+from src.controllers.health_controller import health
+from src import config, startup
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -10,15 +12,19 @@ api = Blueprint('', __name__)
 # register new routes with api blueprint
 plan_path = f"{config.VERSION}/plan"
 api.register_blueprint(plans, url_prefix=plan_path)
+api.register_blueprint(health)
 
 @api.before_app_request
 def before_request():
-    logger.info("Request started for {}: {}".format(request.method, request.url_rule))
+    if startup["first_request_ms"] is None:
+        startup["first_request_ms"] = round((time.perf_counter() - startup["started"]) * 1000, 1)
+        logger.info("First request %s ms after start", startup["first_request_ms"])
+    logger.info("Request started for %s: %s", request.method, request.url_rule)
 
 # updating headers after completion
 @api.after_app_request
 def add_header(response: Response) -> Response:
-    logger.info("Request completed for {}: {}".format(request.method, request.url_rule))
+    logger.info("Request completed for %s: %s", request.method, request.url_rule)
     return response
 
 # removing body data from 405 method response
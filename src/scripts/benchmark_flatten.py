@@ -0,0 +1,182 @@
+import argparse
+import copy
+import json
+import time
+from src import plan_model
+
+# Hand coded decomposition and assembly the schema driven PlanGraph replaced, kept to
+# check that both produce the same records, documents and plans and to compare speed
+
+def legacy_reference(data: dict) -> str:
+    return "{}:{}".format(data["objectType"], data["objectId"])
+
+def legacy_flatten_plan(plan: dict) -> dict:
+    plan_id = plan["objectId"]
+    records = {}
+    stored_plan = {k: v for k, v in plan.items() if k not in ["planCostShares", "linkedPlanServices"]}
+
+    stored_plan["planCostShares"] = legacy_reference(plan["planCostShares"])
+    records[plan_model.get_child_key(plan_id, stored_plan["planCostShares"])] = json.dumps(plan["planCostShares"])
+
+    stored_plan["linkedPlanServices"] = []
+    for linked_service in plan["linkedPlanServices"]:
+        stored_service = dict(linked_service)
+        for key in plan_model.SERVICE_CHILDREN:
+            stored_service[key] = legacy_reference(linked_service[key])
+            records[plan_model.get_child_key(plan_id, stored_service[key])] = json.dumps(linked_service[key])
+        linked_plan_service_name = legacy_reference(linked_service)
+        records[plan_model.get_child_key(plan_id, linked_plan_service_name)] = json.dumps(stored_service)
+        stored_plan["linkedPlanServices"].append(linked_plan_service_name)
+
+    return {plan_model.get_key(plan_id): json.dumps(stored_plan), **records}
+
+def legacy_build_es_actions(plan: dict) -> list:
+    def action(data, join_field, routing=None):
+        document = {k: v for k, v in data.items() if not isinstance(v, (dict, list))}
+        document["join_field"] = join_field
+        es_action = {"_index": plan_model.INDEX_NAME, "_id": data["objectId"], "_source": document}
+        if routing:
+            es_action["_routing"] = routing
+        return es_action
+
+    plan_id = plan["objectId"]
+    actions = [action(plan, {"name": "plan"})]
+    if plan.get("planCostShares"):
+        actions.append(action(plan["planCostShares"], {"name": "planCostShare", "parent": plan_id}, plan_id))
+    for linked_service in plan.get("linkedPlanServices") or []:
+        linked_plan_service_id = linked_service["objectId"]
+        actions.append(action(linked_service, {"name": "linkedPlanService", "parent": plan_id}, plan_id))
+        for key, name in (("linkedService", "linkedService"), ("planserviceCostShares", "planserviceCostShare")):
+            if linked_service.get(key):
+                actions.append(action(linked_service[key], {"name": name, "parent": linked_plan_service_id}, plan_id))
+    return actions
+
+def legacy_plan_members(plan: dict, actions: list):
+    children = [plan["planCostShares"]] if plan.get("planCostShares") else []
+    for linked_service in plan.get("linkedPlanServices") or []:
+        children.append(linked_service)
+        children.extend(linked_service[key] for key in ("linkedService", "planserviceCostShares") if linked_service.get(key))
+    keys = [plan_model.get_child_key(plan["objectId"], legacy_reference(child)) for child in children]
+    documents = [[action["_id"], action.get("_routing")] for action in actions]
+    return keys, documents
+
+def legacy_decompose(plan: dict):
+    records = legacy_flatten_plan(plan)
+    actions = legacy_build_es_actions(plan)
+    keys, documents = legacy_plan_members(plan, actions)
+    return records, actions, documents, keys
+
+def legacy_assemble(plans: list, get_values) -> list:
+    def child_key(plan, reference):
+        return plan_model.get_child_key(plan["objectId"], reference)
+
+    keys = [child_key(plan, plan["planCostShares"]) for plan in plans if plan.get("planCostShares")]
+    keys += [child_key(plan, service) for plan in plans for service in plan.get("linkedPlanServices") or []]
+    children = dict(zip(keys, get_values(keys)))
+
+    keys = []
+    for plan in plans:
+        for service in plan.get("linkedPlanServices") or []:
+            child = children.get(child_key(plan, service)) or {}
+            keys.extend(child_key(plan, child[key]) for key in plan_model.SERVICE_CHILDREN if child.get(key))
+    children.update(zip(keys, get_values(keys)))
+
+    for plan in plans:
+        if plan.get("planCostShares"):
+            plan["planCostShares"] = children.get(child_key(plan, plan["planCostShares"]))
+        linked_plan_services = []
+        for service in plan.get("linkedPlanServices") or []:
+            temp_service = dict(children.get(child_key(plan, service)) or {})
+            for key in plan_model.SERVICE_CHILDREN:
+                if temp_service.get(key):
+                    temp_service[key] = children.get(child_key(plan, temp_service[key]))
+            linked_plan_services.append(temp_service)
+        plan["linkedPlanServices"] = linked_plan_services
+    return plans
+
+def synthetic_plan(plan: dict, services: int) -> dict:
+    # the use case plan with its linked plan service repeated under new object ids
+    plan = copy.deepcopy(plan)
+    template = plan["linkedPlanServices"][0]
+    plan["linkedPlanServices"] = []
+    for i in range(services):
+        service = copy.deepcopy(template)
+        for data in (service, service["linkedService"], service["planserviceCostShares"]):
+            data["objectId"] = "{}-{}".format(data["objectId"], i)
+        plan["linkedPlanServices"].append(service)
+    return plan
+
+def values_reader(records: dict):
+    # get_multiple_values over the decomposed records, decoded on every read like an MGET
+    # so only the CPU side of assembly is measured
+    return lambda keys: [json.loads(records[key]) if key in records else None for key in keys]
+
+def check_equivalent(plan: dict):
+    records, actions, documents, keys = legacy_decompose(plan)
+    decomposition = plan_model.decompose_plan(plan)
+    checks = {
+        "records": (
+            {key: json.loads(value) for key, value in records.items()},
+            {key: json.loads(value) for key, value in decomposition.records.items()}
+        ),
+        "record order": (next(iter(records)), next(iter(decomposition.records))),
+        "actions": (sorted(actions, key=json.dumps), sorted(decomposition.actions, key=json.dumps)),
+        "documents": (sorted(documents), sorted(decomposition.documents)),
+        "keys": (sorted(keys), sorted(decomposition.keys))
+    }
+
+    get_values = values_reader(decomposition.records)
+    root_key = plan_model.get_key(plan["objectId"])
+    checks["assembled"] = (
+        legacy_assemble(get_values([root_key]), get_values)[0],
+        plan_model.plan_graph.assemble(get_values([root_key]), get_values)[0]
+    )
+    checks["round trip"] = (plan, checks["assembled"][1])
+
+    for name, (legacy, graph) in checks.items():
+        if legacy != graph:
+            raise SystemExit("PlanGraph differs from the legacy decomposition: {}".format(name))
+
+def measure(function, plan, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function(plan)
+    return iterations / (time.perf_counter() - started)
+
+# Usage: python -m src.scripts.benchmark_flatten [--services 50] [--iterations 2000]
+def main():
+    parser = argparse.ArgumentParser(description="Compare the schema driven plan decomposition with the hand coded one")
+    parser.add_argument("--plan", default="use case.txt", help="JSON plan used as the use case")
+    parser.add_argument("--services", type=int, default=50, help="linked plan services of the synthetic plan")
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    with open(args.plan) as plan_file:
+        use_case = json.load(plan_file)
+    plan_model.validate_data(use_case)
+
+    def assemble(assemble_plans):
+        # reads the records decomposed once, decoding them as an MGET would
+        def run(plan):
+            get_values = values_reader(records[plan["objectId"]])
+            return assemble_plans(get_values([plan_model.get_key(plan["objectId"])]), get_values)
+        return run
+
+    cases = {
+        "decompose": (legacy_decompose, plan_model.decompose_plan),
+        "assemble": (assemble(legacy_assemble), assemble(plan_model.plan_graph.assemble))
+    }
+
+    records = {}
+    for name, plan in (("use case", use_case), ("{} services".format(args.services), synthetic_plan(use_case, args.services))):
+        check_equivalent(plan)
+        records[plan["objectId"]] = plan_model.decompose_plan(plan).records
+        for case, (legacy, graph) in cases.items():
+            legacy_rate = measure(legacy, plan, args.iterations)
+            graph_rate = measure(graph, plan, args.iterations)
+            print("{:<14} {:<10} legacy {:>10.0f} ops/s  graph {:>10.0f} ops/s  {:.2f}x".format(
+                name, case, legacy_rate, graph_rate, graph_rate / legacy_rate
+            ))
+
+if __name__ == "__main__":
+    main()
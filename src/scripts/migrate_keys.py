@@ -0,0 +1,141 @@
+import argparse
+import json
+import logging
+from redis import Redis
+from src import plan_model, config
+from src.utils import Checkpoint, ProgressReporter
+
+logger = logging.getLogger(__name__)
+
+# Legacy layout: plans under their raw objectId, children under objectType:objectId shared
+# by every plan that references them, plan etags under <plan_id>:<etag>, the member indexes
+# under <plan_id>:keys / <plan_id>:documents and listing etags under the raw etag
+
+def get_values(source: Redis, keys: list) -> list:
+    return [json.loads(value) if value else None for value in source.mget(keys)] if keys else []
+
+def read_legacy_etags(source: Redis, keys: list) -> list:
+    # (plan id, etag, stored plan) of the <plan_id>:<etag> keys of one SCAN page. Older plans did
+    # not track them in <plan_id>:keys, they are told from children by their value, the plan itself
+    keys = [key for key in keys if key.count(":") == 1 and key.split(":")[1] not in ("keys", "documents")]
+    return [
+        (plan_id, etag, value) for (plan_id, etag), value in zip((key.split(":") for key in keys), get_values(source, keys))
+        if isinstance(value, dict) and value.get("objectType") == "plan" and value.get("objectId") == plan_id
+    ]
+
+def read_legacy_page(source: Redis, keys: list) -> tuple:
+    # ([complete plan, tracked etags], plan etags, legacy keys of every plan and etag) of one SCAN page
+    plan_etags = read_legacy_etags(source, keys)
+    keys = [key for key in keys if ":" not in key]
+    values = get_values(source, keys)
+    plans = [value for value in values if isinstance(value, dict) and value.get("objectType") == "plan"]
+    legacy_keys = [key for key, value in zip(keys, values) if isinstance(value, list)]
+    legacy_keys += [f"{plan_id}:{etag}" for plan_id, etag, _ in plan_etags]
+
+    references = [plan["planCostShares"] for plan in plans if plan.get("planCostShares")]
+    references += [service for plan in plans for service in plan.get("linkedPlanServices") or []]
+    children = dict(zip(references, get_values(source, references)))
+    references = [
+        child[key] for child in list(children.values()) if child
+        for key in plan_model.SERVICE_CHILDREN if isinstance(child.get(key), str)
+    ]
+    children.update(zip(references, get_values(source, references)))
+
+    pipeline = source.pipeline(transaction=False)
+    for plan in plans:
+        pipeline.smembers("{}:keys".format(plan["objectId"]))
+    members = pipeline.execute()
+
+    complete_plans = []
+    for plan, plan_members in zip(plans, members):
+        plan_id = plan["objectId"]
+        plan_members = [member.decode("utf-8") for member in plan_members]
+        complete_plan = dict(plan)
+        if plan.get("planCostShares"):
+            complete_plan["planCostShares"] = children.get(plan["planCostShares"])
+        complete_plan["linkedPlanServices"] = []
+        for reference in plan.get("linkedPlanServices") or []:
+            service = dict(children.get(reference) or {})
+            for key in plan_model.SERVICE_CHILDREN:
+                if service.get(key):
+                    legacy_keys.append(service[key])
+                    service[key] = children.get(service[key])
+            complete_plan["linkedPlanServices"].append(service)
+        # the etags tracked in the keys index, older plans did not track them
+        etags = [member[len(plan_id) + 1:] for member in plan_members if member.startswith(f"{plan_id}:")]
+        complete_plans.append([complete_plan, etags])
+
+        legacy_keys += [plan_id, f"{plan_id}:keys", f"{plan_id}:documents", *plan_members]
+        legacy_keys += [plan["planCostShares"]] if plan.get("planCostShares") else []
+        legacy_keys += plan.get("linkedPlanServices") or []
+    return complete_plans, plan_etags, legacy_keys
+
+def copy_plans(plans: list, plan_etags: list) -> tuple:
+    # writes the plans in the hash tagged layout, returns (copied, skipped)
+    # a plan etag can be on another page than its plan, it keeps the plan it was stored with
+    for plan_id, etag, plan in plan_etags:
+        plan_model.create_etag(plan_id, etag, plan=plan)
+    copied, hashes, copied_plans = 0, {}, {}
+    for plan, etags in plans:
+        try:
+            plan_model.validate_data(plan)
+        except ValueError as e:
+            logger.error("Skipping plan %s -> %s", plan.get("objectId"), e)
+            continue
+        plan_id = plan["objectId"]
+        decomposition = plan_model.decompose_plan(plan)
+        plan_model.write_plan_graph(plan_id, decomposition.records, decomposition.documents)
+        for etag in etags:
+            plan_model.create_etag(plan_id, etag)
+        hashes[plan_id] = plan_model.get_content_hash(plan)
+        copied_plans[plan_id] = plan
+        copied += 1
+    if hashes:
+        plan_model.redis_client.hset(plan_model.CONTENT_HASHES, mapping=hashes)
+        plan_model.update_aggregates(copied_plans)
+    return copied, len(plans) - copied
+
+# Usage: python -m src.scripts.migrate_keys [--source-host old-redis] [--delete-old]
+def main():
+    parser = argparse.ArgumentParser(description="Copy plans from the legacy Redis key layout to the hash tagged layout")
+    parser.add_argument("--source-host", default=config.REDIS_HOST, help="Redis holding the legacy keys, defaults to the configured one")
+    parser.add_argument("--source-port", type=int, default=int(config.REDIS_PORT or 6379))
+    parser.add_argument("--source-db", type=int, default=0)
+    parser.add_argument("--scan-count", type=int, default=1000, help="keys per Redis SCAN page")
+    parser.add_argument("--delete-old", action="store_true", help="delete the legacy keys once every plan is copied")
+    parser.add_argument("--checkpoint", default="logs/migrate_keys.json", help="checkpoint file used to resume")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    args = parser.parse_args()
+
+    source = Redis(host=args.source_host, port=args.source_port, db=args.source_db)
+    checkpoint = Checkpoint(args.checkpoint)
+    state = {} if args.restart else checkpoint.load()
+    phase, cursor = state.get("phase", "copy"), state.get("cursor", 0)
+    progress = ProgressReporter("migrate_keys", counts=state.get("counts", {"plans": 0, "skipped": 0, "deleted": 0}))
+    if cursor:
+        logger.info("Resuming %s phase from cursor %s", phase, cursor)
+
+    # Children of the legacy layout can be shared by several plans, so nothing
+    # is deleted before every plan has been copied
+    for current_phase in ("copy", "delete") if args.delete_old else ("copy",):
+        if phase != current_phase:
+            continue
+        while True:
+            cursor, keys = source.scan(cursor=cursor, count=args.scan_count)
+            plans, plan_etags, legacy_keys = read_legacy_page(source, [key.decode("utf-8") for key in keys])
+            if current_phase == "copy":
+                copied, skipped = copy_plans(plans, plan_etags)
+                progress.add(plans=copied, skipped=skipped)
+            elif legacy_keys:
+                progress.add(deleted=source.delete(*set(legacy_keys)))
+            checkpoint.save({"phase": current_phase, "cursor": cursor, "counts": progress.counts})
+            if not cursor:
+                break
+        phase = "delete"
+
+    checkpoint.clear()
+    progress.report()
+    print("Migration completed: {}".format(progress.summary()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from src import plan_model, es_config
+from src.utils import Checkpoint, ProgressReporter
+
+logger = logging.getLogger(__name__)
+
+def index_plans(plans: list, chunk_size: int):
+    # the content hash of a plan is only set once all of its documents are indexed
+    actions = {plan["objectId"]: plan_model.build_es_actions(plan) for plan in plans}
+    hashes = {plan["objectId"]: plan_model.get_content_hash(plan) for plan in plans}
+    success, errors, _ = plan_model.bulk_index_plans(actions, hashes, chunk_size=chunk_size)
+    for error in errors[:5]:
+        logger.error("Failed to index document -> %s", error)
+    return len(plans), success, len(errors)
+
+# Usage: python -m src.scripts.rebuild_es [--workers 8] [--checkpoint logs/rebuild_es.json]
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the Elasticsearch plans index from Redis")
+    parser.add_argument("--workers", type=int, default=8, help="parallel bulk indexing threads")
+    parser.add_argument("--scan-count", type=int, default=2000, help="keys per Redis SCAN page")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="documents per bulk request")
+    parser.add_argument("--checkpoint", default="logs/rebuild_es.json", help="checkpoint file used to resume")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument("--bulk-settings", action="store_true", help="disable refresh and replicas during the load")
+    args = parser.parse_args()
+
+    checkpoint = Checkpoint(args.checkpoint)
+    state = {} if args.restart else checkpoint.load()
+    cursor = state.get("cursor", 0)
+    progress = ProgressReporter("rebuild_es", counts=state.get("counts", {"plans": 0, "documents": 0, "errors": 0}))
+    if cursor:
+        logger.info("Resuming rebuild from cursor %s", cursor)
+
+    # a lost index is created again behind the alias before anything is written
+    if not es_config.ensure_index(force=True):
+        raise SystemExit("Elasticsearch index {} is not available".format(es_config.INDEX_ALIAS))
+    write_indices = es_config.get_alias_indices() if args.bulk_settings else []
+    write_index = write_indices[0] if write_indices else None
+    restore_settings = es_config.start_bulk_load(write_index) if write_index else None
+
+    try:
+        # (cursor after the page, future) in scan order, the checkpoint only
+        # moves past a page once it and every page before it are indexed
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            while True:
+                next_cursor, plans = plan_model.scan_plans(cursor, count=args.scan_count)
+                pending.append((next_cursor, executor.submit(index_plans, plans, args.chunk_size)))
+                cursor = next_cursor
+
+                while pending and (pending[0][1].done() or len(pending) > args.workers * 2 or not cursor):
+                    page_cursor, future = pending.popleft()
+                    plans_count, success, errors = future.result()
+                    progress.add(plans=plans_count, documents=success, errors=errors)
+                    checkpoint.save({"cursor": page_cursor, "counts": progress.counts})
+
+                if not cursor:
+                    break
+    finally:
+        if restore_settings:
+            es_config.restore_bulk_settings(write_index, restore_settings)
+
+    checkpoint.clear()
+    progress.report()
+    print("Rebuild completed: {}".format(progress.summary()))
+
+if __name__ == "__main__":
+    main()
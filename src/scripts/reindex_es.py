@@ -0,0 +1,29 @@
+import argparse
+import logging
+from src import es_config
+from src.reconciler import PlanReconciler
+
+logger = logging.getLogger(__name__)
+
+# Usage: python -m src.scripts.reindex_es --version 2
+def main():
+    parser = argparse.ArgumentParser(description="Reindex the plans alias into a new versioned index and swap the alias")
+    parser.add_argument("--version", type=int, required=True, help="version of the new physical index")
+    parser.add_argument("--slices", default="auto", help="number of parallel reindex slices")
+    parser.add_argument("--delete-old", action="store_true", help="delete the previous index after the swap")
+    args = parser.parse_args()
+
+    slices = int(args.slices) if args.slices.isdigit() else args.slices
+    # plans changed from here on may be stale or missing in the copy, they are
+    # reconciled from Redis into the new index once the alias points at it
+    reconciler = PlanReconciler()
+    since_id = reconciler.get_last_change_id()
+    result = es_config.reindex(args.version, slices=slices, delete_old=args.delete_old)
+    logger.info("Reindex completed %s -> %s", result["source"], result["target"])
+    requeued = reconciler.requeue_changes(since_id)
+    print("Reindexed {total} documents from {source} to {target}, {requeued} changed plans queued for the reconciler".format(
+        requeued=requeued, **result
+    ))
+
+if __name__ == "__main__":
+    main()
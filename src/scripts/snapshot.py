@@ -0,0 +1,193 @@
+import argparse
+import gzip
+import json
+import logging
+import mmap
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from src import plan_model, es_config
+from src.utils import Checkpoint, ProgressReporter
+
+logger = logging.getLogger(__name__)
+
+# Snapshots are NDJSON, one complete plan per line, gzip compressed when the path ends
+# in .gz. ETags are not exported, they are recreated as plans are served again
+
+def is_compressed(path: str) -> bool:
+    return path.endswith(".gz")
+
+def encode_page(plans: list, compress: bool) -> bytes:
+    data = b"".join(json.dumps(plan, separators=(",", ":")).encode("utf-8") + b"\n" for plan in plans)
+    # every page is a complete gzip member, a truncated file can be appended to after a resume
+    return gzip.compress(data) if compress else data
+
+def export_snapshot(args):
+    checkpoint = Checkpoint(args.checkpoint)
+    state = {} if args.restart else checkpoint.load()
+    if state and state.get("path") != args.path:
+        logger.warning("Ignoring checkpoint of %s", state.get("path"))
+        state = {}
+    cursor, offset = state.get("cursor", 0), state.get("offset", 0)
+    progress = ProgressReporter("snapshot export", counts=state.get("counts", {"plans": 0, "bytes": 0}))
+    if offset:
+        logger.info("Resuming export from cursor %s at offset %s", cursor, offset)
+
+    # One SCAN page of plans is held in memory at a time. SCAN can return a plan twice,
+    # the import overwrites so duplicates are harmless
+    with open(args.path, "r+b" if offset else "wb") as snapshot:
+        snapshot.truncate(offset)
+        snapshot.seek(offset)
+        while True:
+            cursor, plans = plan_model.scan_plans(cursor, count=args.scan_count)
+            if plans:
+                data = encode_page(plans, is_compressed(args.path))
+                snapshot.write(data)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+                offset += len(data)
+                progress.add(plans=len(plans), bytes=len(data))
+            checkpoint.save({"path": args.path, "cursor": cursor, "offset": offset, "counts": progress.counts})
+            if not cursor:
+                break
+
+    checkpoint.clear()
+    progress.report()
+    print("Export completed: {}".format(progress.summary()))
+
+def read_lines(path: str, offset: int):
+    # yields (line, offset after the line). Offsets of compressed snapshots are positions
+    # in the uncompressed stream, resuming decompresses up to them without keeping the data
+    if is_compressed(path):
+        with gzip.open(path, "rb") as snapshot:
+            snapshot.seek(offset)
+            for line in snapshot:
+                offset += len(line)
+                yield line, offset
+        return
+
+    if not os.path.getsize(path):
+        return
+    with open(path, "rb") as snapshot, mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        mapped.seek(offset)
+        for line in iter(mapped.readline, b""):
+            offset += len(line)
+            yield line, offset
+
+def read_batches(path: str, offset: int, batch_size: int):
+    # yields (plans, offset after the batch)
+    plans = []
+    for line, offset in read_lines(path, offset):
+        if line.strip():
+            plans.append(json.loads(line))
+        if len(plans) >= batch_size:
+            yield plans, offset
+            plans = []
+    if plans:
+        yield plans, offset
+
+def decompose_plans(plans: list) -> tuple:
+    # (plan_id -> plan, plan_id -> Decomposition, plan_id -> content hash, skipped) of the valid plans
+    valid, decompositions, hashes = {}, {}, {}
+    for plan in plans:
+        try:
+            plan_model.validate_data(plan)
+        except ValueError as e:
+            logger.error("Skipping plan %s -> %s", plan.get("objectId"), e)
+            continue
+        plan_id = plan["objectId"]
+        valid[plan_id] = plan
+        hashes[plan_id] = plan_model.get_content_hash(plan)
+        # the content hash is set on the plan document once all of its documents are loaded
+        decompositions[plan_id] = plan_model.decompose_plan(plan)
+    return valid, decompositions, hashes, len(plans) - len(decompositions)
+
+def load_redis(plans: dict, decompositions: dict, hashes: dict) -> int:
+    plan_model.write_plan_graphs(decompositions, hashes)
+    plan_model.update_aggregates(plans)
+    return len(decompositions)
+
+def load_elasticsearch(decompositions: dict, hashes: dict, chunk_size: int) -> tuple:
+    actions = {plan_id: decomposition.actions for plan_id, decomposition in decompositions.items()}
+    success, errors, _ = plan_model.bulk_index_plans(actions, hashes, chunk_size=chunk_size)
+    for error in errors[:5]:
+        logger.error("Failed to index document -> %s", error)
+    return success, len(errors)
+
+def import_snapshot(args):
+    checkpoint = Checkpoint(args.checkpoint)
+    state = {} if args.restart else checkpoint.load()
+    if state and state.get("path") != args.path:
+        logger.warning("Ignoring checkpoint of %s", state.get("path"))
+        state = {}
+    offset = state.get("offset", 0)
+    progress = ProgressReporter("snapshot import", counts=state.get("counts", {"plans": 0, "skipped": 0, "documents": 0, "errors": 0}))
+    if offset:
+        logger.info("Resuming import at offset %s", offset)
+
+    if not args.skip_es and not es_config.ensure_index(force=True):
+        raise SystemExit("Elasticsearch index {} is not available, use --skip-es to only load Redis".format(es_config.INDEX_ALIAS))
+    write_indices = es_config.get_alias_indices() if args.bulk_settings and not args.skip_es else []
+    write_index = write_indices[0] if write_indices else None
+    restore_settings = es_config.start_bulk_load(write_index) if write_index else None
+
+    def commit(batch):
+        batch_offset, skipped, redis_future, es_future = batch
+        plans = redis_future.result()
+        documents, errors = es_future.result() if es_future else (0, 0)
+        progress.add(plans=plans, skipped=skipped, documents=documents, errors=errors)
+        checkpoint.save({"path": args.path, "offset": batch_offset, "counts": progress.counts})
+
+    try:
+        # The Redis pipeline and the ES bulk request of a batch run side by side, with up to
+        # 2 x workers batches in flight. The offset only moves past a batch once it and
+        # every batch before it are written to both stores
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            for plans, batch_offset in read_batches(args.path, offset, args.batch_size):
+                valid, decompositions, hashes, skipped = decompose_plans(plans)
+                redis_future = executor.submit(load_redis, valid, decompositions, hashes)
+                es_future = None if args.skip_es else executor.submit(load_elasticsearch, decompositions, hashes, args.chunk_size)
+                pending.append((batch_offset, skipped, redis_future, es_future))
+
+                while pending and (all(future.done() for future in pending[0][2:] if future) or len(pending) > args.workers * 2):
+                    commit(pending.popleft())
+            while pending:
+                commit(pending.popleft())
+    finally:
+        if restore_settings:
+            es_config.restore_bulk_settings(write_index, restore_settings)
+
+    checkpoint.clear()
+    progress.report()
+    print("Import completed: {}".format(progress.summary()))
+
+# Usage: python -m src.scripts.snapshot export plans.ndjson.gz
+#        python -m src.scripts.snapshot import plans.ndjson.gz [--workers 4] [--skip-es]
+def main():
+    parser = argparse.ArgumentParser(description="Export or import every complete plan as NDJSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="stream every plan in Redis to a snapshot file")
+    export_parser.add_argument("path", help="snapshot file, gzip compressed when it ends in .gz")
+    export_parser.add_argument("--scan-count", type=int, default=1000, help="keys per Redis SCAN page")
+    export_parser.add_argument("--checkpoint", default="logs/snapshot_export.json", help="checkpoint file used to resume")
+    export_parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    export_parser.set_defaults(run=export_snapshot)
+
+    import_parser = commands.add_parser("import", help="load a snapshot file into Redis and Elasticsearch")
+    import_parser.add_argument("path", help="snapshot file, gzip compressed when it ends in .gz")
+    import_parser.add_argument("--workers", type=int, default=4, help="parallel Redis and bulk indexing threads")
+    import_parser.add_argument("--batch-size", type=int, default=500, help="plans per Redis pipeline")
+    import_parser.add_argument("--chunk-size", type=int, default=1000, help="documents per bulk request")
+    import_parser.add_argument("--skip-es", action="store_true", help="only load Redis, rebuild_es can index later")
+    import_parser.add_argument("--bulk-settings", action="store_true", help="disable refresh and replicas during the load")
+    import_parser.add_argument("--checkpoint", default="logs/snapshot_import.json", help="checkpoint file used to resume")
+    import_parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    import_parser.set_defaults(run=import_snapshot)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import argparse
+import json
+import logging
+import sys
+from src import plan_model
+from src.utils import ProgressReporter
+
+logger = logging.getLogger(__name__)
+
+# tolerance of float totals kept with HINCRBYFLOAT
+EPSILON = 1e-6
+
+def totals_differ(expected: dict, actual: dict) -> bool:
+    if not expected or not actual:
+        return bool(expected) != bool(actual)
+    return any(abs(expected[field] - actual.get(field, 0)) > EPSILON for field in plan_model.AGGREGATE_FIELDS)
+
+def add_totals(groups: dict, summary: dict):
+    group = groups.setdefault((summary["_org"], summary["planType"]), dict.fromkeys(plan_model.AGGREGATE_FIELDS, 0))
+    for field in plan_model.AGGREGATE_FIELDS:
+        group[field] += summary[field]
+
+# Usage: python -m src.scripts.verify_aggregates [--fix]
+def main():
+    parser = argparse.ArgumentParser(description="Recompute the cost share aggregates from every plan and compare them with Redis")
+    parser.add_argument("--scan-count", type=int, default=1000, help="keys per Redis SCAN page")
+    parser.add_argument("--fix", action="store_true", help="overwrite drifted plan summaries and group totals")
+    args = parser.parse_args()
+
+    # changes a crashed writer left half applied are completed before anything is compared
+    replayed = plan_model.replay_aggregate_changes()
+
+    # Changes applied by the consumer during the pass show up as drift, stop it before --fix.
+    # Group totals and the ids of seen plans are kept in memory, SCAN can return a plan twice
+    progress = ProgressReporter("verify_aggregates", counts={"replayed": replayed, "plans": 0, "drifted_plans": 0, "drifted_groups": 0})
+    groups, seen, cursor = {}, set(), 0
+    while True:
+        cursor, plans = plan_model.scan_plans(cursor, count=args.scan_count)
+        summaries = {
+            plan["objectId"]: plan_model.summarize_cost_shares(plan) for plan in plans if plan["objectId"] not in seen
+        }
+        seen.update(summaries)
+        stored = plan_model.get_multiple_values([plan_model.get_aggregates_key(plan_id) for plan_id in summaries])
+
+        drifted = {}
+        for (plan_id, summary), value in zip(summaries.items(), stored):
+            add_totals(groups, summary)
+            if value != summary:
+                logger.warning("Plan %s aggregates drifted -> %s", plan_id, value)
+                drifted[plan_model.get_aggregates_key(plan_id)] = json.dumps(summary)
+        if drifted and args.fix:
+            pipeline = plan_model.redis_client.pipeline(transaction=False)
+            for key, summary in drifted.items():
+                pipeline.set(key, summary)
+            pipeline.execute()
+        progress.add(plans=len(summaries), drifted_plans=len(drifted))
+        if not cursor:
+            break
+
+    known = [tuple(group) for group in plan_model.get_aggregate_groups()]
+    names = list(dict.fromkeys(known + list(groups)))
+    pipeline = plan_model.redis_client.pipeline(transaction=False)
+    for group, totals in zip(names, plan_model.get_group_totals(names)):
+        expected = groups.get(group)
+        if not totals_differ(expected, totals):
+            continue
+        logger.warning("Group %s aggregates drifted -> expected %s, stored %s", group, expected, totals)
+        progress.add(drifted_groups=1)
+        key = plan_model.get_group_key(*group)
+        pipeline.delete(key)
+        if expected:
+            pipeline.hset(key, mapping=expected)
+            pipeline.sadd(plan_model.AGGREGATE_GROUPS, json.dumps(list(group)))
+        else:
+            pipeline.srem(plan_model.AGGREGATE_GROUPS, json.dumps(list(group)))
+    if args.fix:
+        pipeline.execute()
+
+    progress.report()
+    drift = progress.counts["drifted_plans"] or progress.counts["drifted_groups"]
+    print("Verification {}: {}".format("fixed drift" if drift and args.fix else "found drift" if drift else "passed", progress.summary()))
+    if drift and not args.fix:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
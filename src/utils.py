@@ -0,0 +1,126 @@
+import json
+import os
+import time
+import uuid
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Checkpoint:
+    # JSON state file for resumable maintenance scripts, written atomically
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as checkpoint_file:
+            return json.load(checkpoint_file)
+
+    def save(self, state: dict):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.replace(temp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class ProgressReporter:
+    # Accumulates counters and logs totals and per second rates every interval seconds
+    def __init__(self, name: str, interval: float = 5.0, counts: dict = None):
+        self.name = name
+        self.interval = interval
+        self.counts = dict(counts or {})
+        self.start_counts = dict(self.counts)
+        self.started = time.monotonic()
+        self.last_report = self.started
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+        if time.monotonic() - self.last_report >= self.interval:
+            self.report()
+
+    def rate(self, key: str) -> float:
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return (self.counts.get(key, 0) - self.start_counts.get(key, 0)) / elapsed
+
+    def summary(self) -> str:
+        return ", ".join(
+            "{}={} ({:.1f}/s)".format(key, value, self.rate(key)) for key, value in self.counts.items()
+        )
+
+    def report(self):
+        self.last_report = time.monotonic()
+        logger.info("%s progress: %s", self.name, self.summary())
+
+class SingleFlight:
+    # Concurrent calls for the same key share the result of one in-flight call.
+    # With a Redis client the leader also holds a short lock so callers in other
+    # processes wait for its result instead of repeating the call. Results must be
+    # JSON serializable.
+    RELEASE_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, redis_client=None, lock_ms=2000, poll_interval=0.01):
+        self.redis_client = redis_client
+        self.lock_ms = lock_ms
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.release_script = redis_client.register_script(self.RELEASE_SCRIPT) if redis_client else None
+
+    def do(self, key: str, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {"event": threading.Event(), "result": None, "error": None}
+
+        if not leader:
+            call["event"].wait()
+            if call["error"]:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = self.do_shared(key, fn) if self.redis_client else fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["event"].set()
+
+    def do_shared(self, key: str, fn):
+        lock_key = f"singleflight:{key}"
+        token = uuid.uuid4().hex
+        if self.redis_client.set(lock_key, token, nx=True, px=self.lock_ms):
+            try:
+                result = fn()
+                self.redis_client.set(f"{lock_key}:{token}", json.dumps(result), px=self.lock_ms)
+                return result
+            finally:
+                self.release_script(keys=[lock_key], args=[token])
+
+        # another process is fetching, wait for its result while its lock is held
+        deadline = time.monotonic() + self.lock_ms / 1000
+        leader_token = self.redis_client.get(lock_key)
+        while leader_token and time.monotonic() < deadline:
+            result = self.redis_client.get(f"{lock_key}:{leader_token.decode('utf-8')}")
+            if result is not None:
+                logger.debug("Shared result of %s from another process", key)
+                return json.loads(result)
+            if self.redis_client.get(lock_key) != leader_token:
+                break
+            time.sleep(self.poll_interval)
+        return fn()
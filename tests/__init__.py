@@ -0,0 +1,12 @@
+import json
+import os
+
+# Every test module imports the app, which opens no connections. Warmup would try to reach them
+os.environ.setdefault("DEV_WARMUP", "false")
+
+USE_CASE_PATH = os.path.join(os.path.dirname(__file__), "..", "use case.txt")
+
+def load_use_case() -> dict:
+    # a fresh copy of the sample plan for every caller
+    with open(USE_CASE_PATH) as plan_file:
+        return json.load(plan_file)
@@ -0,0 +1,48 @@
+import unittest
+from src import plan_model
+from tests import load_use_case
+
+class SummarizeCostSharesTest(unittest.TestCase):
+    def setUp(self):
+        self.plan = load_use_case()
+
+    def test_use_case(self):
+        cost_shares = [self.plan["planCostShares"]] + [service["planserviceCostShares"] for service in self.plan["linkedPlanServices"]]
+        self.assertEqual(plan_model.summarize_cost_shares(self.plan), {
+            "_org": self.plan["_org"],
+            "planType": self.plan["planType"],
+            "plans": 1,
+            "cost_shares": len(cost_shares),
+            "deductible": sum(cost_share["deductible"] for cost_share in cost_shares),
+            "copays": len(cost_shares),
+            "copay": sum(cost_share["copay"] for cost_share in cost_shares)
+        })
+
+    def test_missing_cost_shares_and_copays(self):
+        self.plan["planCostShares"] = None
+        self.plan["linkedPlanServices"][0]["planserviceCostShares"] = None
+        del self.plan["linkedPlanServices"][1]["planserviceCostShares"]["copay"]
+        remaining = self.plan["linkedPlanServices"][1]["planserviceCostShares"]
+        summary = plan_model.summarize_cost_shares(self.plan)
+        self.assertEqual(summary["cost_shares"], 1)
+        self.assertEqual(summary["deductible"], remaining["deductible"])
+        self.assertEqual((summary["copays"], summary["copay"]), (0, 0))
+
+    def test_without_services(self):
+        self.plan["linkedPlanServices"] = []
+        summary = plan_model.summarize_cost_shares(self.plan)
+        self.assertEqual(summary["cost_shares"], 1)
+        self.assertEqual(summary["copay"], self.plan["planCostShares"]["copay"])
+
+class FormatAggregatesTest(unittest.TestCase):
+    def test_whole_numbers_and_average(self):
+        self.assertEqual(
+            plan_model.format_aggregates({"plans": 2.0, "cost_shares": 4.0, "deductible": 10.5, "copays": 3.0, "copay": 100.0}),
+            {"plans": 2, "cost_shares": 4, "deductible": 10.5, "copays": 3, "copay": 100, "average_copay": 33.33}
+        )
+
+    def test_no_copays(self):
+        self.assertIsNone(plan_model.format_aggregates({"plans": 1, "cost_shares": 0, "deductible": 0, "copays": 0, "copay": 0})["average_copay"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+from src.middlewares.compression_middleware import CompressedBodyCache, ENCODINGS, get_representation_etag
+
+class CompressedBodyCacheTest(unittest.TestCase):
+    def test_get_and_put(self):
+        cache = CompressedBodyCache(max_bytes=100)
+        self.assertIsNone(cache.get(("etag", "gzip")))
+        cache.put(("etag", "gzip"), b"body")
+        self.assertEqual(cache.get(("etag", "gzip")), b"body")
+        self.assertIsNone(cache.get(("etag", "br")))
+
+    def test_evicts_least_recently_used(self):
+        cache = CompressedBodyCache(max_bytes=10)
+        cache.put("a", b"aaaa")
+        cache.put("b", b"bbbb")
+        cache.get("a")
+        cache.put("c", b"cccc")
+        self.assertEqual(cache.get("a"), b"aaaa")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), b"cccc")
+        self.assertEqual(cache.size, 8)
+
+    def test_skips_bodies_larger_than_the_cache(self):
+        cache = CompressedBodyCache(max_bytes=4)
+        cache.put("a", b"aaaaa")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.size, 0)
+
+    def test_keeps_the_first_body_of_a_key(self):
+        cache = CompressedBodyCache(max_bytes=100)
+        cache.put("a", b"first")
+        cache.put("a", b"second")
+        self.assertEqual(cache.get("a"), b"first")
+        self.assertEqual(cache.size, 5)
+
+class RepresentationEtagTest(unittest.TestCase):
+    def test_strips_the_encoding_suffix(self):
+        for encoding in ENCODINGS:
+            self.assertEqual(get_representation_etag(f"abc123-{encoding}"), "abc123")
+
+    def test_keeps_other_etags(self):
+        self.assertEqual(get_representation_etag("abc123"), "abc123")
+        self.assertEqual(get_representation_etag("abc123-deflate"), "abc123-deflate")
+
+if __name__ == "__main__":
+    unittest.main()
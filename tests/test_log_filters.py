@@ -0,0 +1,50 @@
+import logging
+import unittest
+from unittest import mock
+from src.config.log_filters import RateLimitFilter
+
+def make_record(name="src.test", level=logging.DEBUG, msg="message %s", args=("a",)):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+class RateLimitFilterTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch("src.config.log_filters.time.monotonic", return_value=100.0)
+        self.clock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_drop(self):
+        log_filter = RateLimitFilter(rate=1, burst=3)
+        self.assertEqual([log_filter.filter(make_record()) for _ in range(5)], [True, True, True, False, False])
+        self.assertEqual(log_filter.dropped["src.test"], 2)
+
+    def test_refill_reports_suppressed(self):
+        log_filter = RateLimitFilter(rate=2, burst=1)
+        self.assertTrue(log_filter.filter(make_record()))
+        self.assertFalse(log_filter.filter(make_record()))
+        self.assertFalse(log_filter.filter(make_record()))
+
+        self.clock.return_value = 100.5
+        record = make_record()
+        self.assertTrue(log_filter.filter(record))
+        self.assertEqual(record.getMessage(), "message a (suppressed 2 similar messages)")
+        self.assertNotIn("src.test", log_filter.dropped)
+
+    def test_buckets_per_logger(self):
+        log_filter = RateLimitFilter(rate=1, burst=1)
+        self.assertTrue(log_filter.filter(make_record("src.first")))
+        self.assertFalse(log_filter.filter(make_record("src.first")))
+        self.assertTrue(log_filter.filter(make_record("src.second")))
+
+    def test_levels_above_max_level_pass(self):
+        log_filter = RateLimitFilter(rate=1, burst=1)
+        self.assertTrue(log_filter.filter(make_record()))
+        for _ in range(3):
+            self.assertTrue(log_filter.filter(make_record(level=logging.INFO)))
+        self.assertFalse(log_filter.filter(make_record()))
+
+    def test_zero_rate_disables(self):
+        log_filter = RateLimitFilter(rate=0, burst=0)
+        self.assertTrue(all(log_filter.filter(make_record()) for _ in range(10)))
+
+if __name__ == "__main__":
+    unittest.main()
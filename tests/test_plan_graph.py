@@ -0,0 +1,123 @@
+import copy
+import json
+import unittest
+from src import plan_model
+from src.models.plan_graph import PlanGraph
+from src.scripts import benchmark_flatten
+from tests import load_use_case
+
+def read_records(records: dict):
+    # get_values over decomposed records, decoded like an MGET
+    return lambda keys: [json.loads(records[key]) if key in records else None for key in keys]
+
+def read_documents(actions: list):
+    # get_children over the documents of bulk actions, honouring the routing of the search
+    def get_children(relation, parent_id, routing=None):
+        return [
+            copy.deepcopy(action["_source"]) for action in actions
+            if action["_source"]["join_field"].get("parent") == parent_id and (routing is None or action.get("_routing") == routing)
+        ]
+    return get_children
+
+class PlanGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.plan = load_use_case()
+        self.plans = [self.plan, benchmark_flatten.synthetic_plan(self.plan, 5)]
+        self.graph = plan_model.plan_graph
+
+    def assemble_from_redis(self, plan, fields=None, depth=2):
+        records = plan_model.decompose_plan(plan).records
+        get_values = read_records(records)
+        return self.graph.assemble(get_values([plan_model.get_key(plan["objectId"])]), get_values, fields, depth)[0]
+
+    def assemble_from_es(self, plan, fields=None, depth=2):
+        actions = plan_model.decompose_plan(plan).actions
+        return self.graph.assemble_documents(copy.deepcopy(actions[0]["_source"]), read_documents(actions), fields, depth)
+
+    def test_round_trip(self):
+        for plan in self.plans:
+            original = copy.deepcopy(plan)
+            self.assertEqual(self.assemble_from_redis(plan), plan)
+            self.assertEqual(self.assemble_from_es(plan), plan)
+            self.assertEqual(plan, original)
+
+    def test_same_as_legacy_decomposition(self):
+        for plan in self.plans:
+            records, actions, documents, keys = benchmark_flatten.legacy_decompose(plan)
+            decomposition = plan_model.decompose_plan(plan)
+            self.assertEqual(
+                {key: json.loads(value) for key, value in decomposition.records.items()},
+                {key: json.loads(value) for key, value in records.items()}
+            )
+            self.assertEqual(next(iter(decomposition.records)), plan_model.get_key(plan["objectId"]))
+            self.assertEqual(sorted(decomposition.actions, key=json.dumps), sorted(actions, key=json.dumps))
+            self.assertEqual(sorted(decomposition.documents), sorted(documents))
+            self.assertEqual(sorted(decomposition.keys), sorted(keys))
+
+            get_values = read_records(decomposition.records)
+            root_key = plan_model.get_key(plan["objectId"])
+            self.assertEqual(
+                self.graph.assemble(get_values([root_key]), get_values),
+                benchmark_flatten.legacy_assemble(get_values([root_key]), get_values)
+            )
+
+    def test_children_routed_by_root(self):
+        plan_id = self.plan["objectId"]
+        decomposition = plan_model.decompose_plan(self.plan, "hash")
+        root, *children = decomposition.actions
+        self.assertEqual(root["_id"], plan_id)
+        self.assertNotIn("_routing", root)
+        self.assertEqual(root["_source"]["content_hash"], "hash")
+        self.assertTrue(children)
+        for action in children:
+            self.assertEqual(action["_routing"], plan_id)
+        self.assertEqual(decomposition.documents, [[plan_id, None]] + [[action["_id"], plan_id] for action in children])
+
+    def test_records_hold_references(self):
+        decomposition = plan_model.decompose_plan(self.plan)
+        stored = json.loads(decomposition.records[plan_model.get_key(self.plan["objectId"])])
+        self.assertEqual(stored["planCostShares"], "membercostshare:" + self.plan["planCostShares"]["objectId"])
+        self.assertEqual(stored["linkedPlanServices"], ["planservice:" + service["objectId"] for service in self.plan["linkedPlanServices"]])
+        self.assertEqual(list(decomposition.records)[1:], decomposition.keys)
+
+    def test_without_records(self):
+        decomposition = plan_model.decompose_plan(self.plan, with_records=False)
+        self.assertEqual(decomposition.records, {})
+        self.assertEqual(decomposition.actions, plan_model.decompose_plan(self.plan).actions)
+
+    def test_depth_and_fields_same_shape_on_both_stores(self):
+        fields = plan_model.parse_fields("planType,linkedPlanServices.linkedService")
+        for depth in (0, 1, 2):
+            for projection in (None, fields):
+                redis_plan = plan_model.project_fields(self.assemble_from_redis(copy.deepcopy(self.plan), projection, depth), projection)
+                es_plan = plan_model.project_fields(self.assemble_from_es(self.plan, projection, depth), projection)
+                self.assertEqual(redis_plan, es_plan, (depth, projection))
+
+    def test_depth_zero_keeps_references(self):
+        plan = self.assemble_from_redis(self.plan, depth=0)
+        self.assertEqual(plan["linkedPlanServices"], ["planservice:" + service["objectId"] for service in self.plan["linkedPlanServices"]])
+
+    def test_depth_one_keeps_grandchild_references(self):
+        plan = self.assemble_from_redis(self.plan, depth=1)
+        service = plan["linkedPlanServices"][0]
+        self.assertEqual(service["linkedService"], "service:" + self.plan["linkedPlanServices"][0]["linkedService"]["objectId"])
+        self.assertEqual(plan["planCostShares"], self.plan["planCostShares"])
+
+    def test_missing_children(self):
+        records = plan_model.decompose_plan(self.plan).records
+        for key in plan_model.decompose_plan(self.plan).keys:
+            if ":planservice:" in key:
+                del records[key]
+        get_values = read_records(records)
+        plan = self.graph.assemble(get_values([plan_model.get_key(self.plan["objectId"])]), get_values)[0]
+        self.assertEqual(plan["linkedPlanServices"], [{}] * len(self.plan["linkedPlanServices"]))
+
+    def test_relations_checked_against_mappings(self):
+        mappings = copy.deepcopy(plan_model.plan_mappings)
+        relations = mappings["mappings"]["properties"]["join_field"]["relations"]
+        relations["plan"] = [relation for relation in relations["plan"] if relation != "linkedPlanService"]
+        with self.assertRaises(ValueError):
+            PlanGraph(plan_model.plan_schema, mappings, plan_model.get_key, plan_model.get_child_key)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import json
+import unittest
+from src import plan_model
+from tests import load_use_case
+
+class ParseFieldsTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertIsNone(plan_model.parse_fields(None))
+        self.assertIsNone(plan_model.parse_fields(""))
+
+    def test_nested_paths(self):
+        self.assertEqual(
+            plan_model.parse_fields("planType, linkedPlanServices.linkedService,linkedPlanServices.planserviceCostShares.copay"),
+            {"planType": {}, "linkedPlanServices": {"linkedService": {}, "planserviceCostShares": {"copay": {}}}}
+        )
+
+    def test_skips_empty_names(self):
+        self.assertEqual(plan_model.parse_fields("planType,,linkedPlanServices."), {"planType": {}, "linkedPlanServices": {}})
+
+class ProjectFieldsTest(unittest.TestCase):
+    def setUp(self):
+        self.plan = load_use_case()
+
+    def test_no_fields_returns_the_data(self):
+        self.assertIs(plan_model.project_fields(self.plan, None), self.plan)
+
+    def test_keeps_identity_of_every_object(self):
+        projected = plan_model.project_fields(self.plan, plan_model.parse_fields("planType,linkedPlanServices.linkedService.name"))
+        self.assertEqual(set(projected), {"objectId", "objectType", "planType", "linkedPlanServices"})
+        for service, original in zip(projected["linkedPlanServices"], self.plan["linkedPlanServices"]):
+            self.assertEqual(set(service), {"objectId", "objectType", "linkedService"})
+            self.assertEqual(service["linkedService"], {
+                key: original["linkedService"][key] for key in ("objectId", "objectType", "name")
+            })
+
+    def test_field_without_subfields_keeps_the_subtree(self):
+        projected = plan_model.project_fields(self.plan, plan_model.parse_fields("planCostShares"))
+        self.assertEqual(projected["planCostShares"], self.plan["planCostShares"])
+
+    def test_does_not_modify_the_input(self):
+        original = json.dumps(self.plan, sort_keys=True)
+        plan_model.project_fields(self.plan, plan_model.parse_fields("planType"))
+        self.assertEqual(json.dumps(self.plan, sort_keys=True), original)
+
+if __name__ == "__main__":
+    unittest.main()
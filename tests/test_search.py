@@ -0,0 +1,83 @@
+import unittest
+from src import plan_model
+
+QUERY = {"term": {"name": "Yearly physical"}}
+
+class WrapJoinQueryTest(unittest.TestCase):
+    def test_same_type_is_not_wrapped(self):
+        self.assertIs(plan_model.wrap_join_query("linkedService", "linkedService", QUERY), QUERY)
+
+    def test_descendant_filter_uses_has_child(self):
+        self.assertEqual(plan_model.wrap_join_query("plan", "linkedService", QUERY), {
+            "has_child": {"type": "linkedPlanService", "query": {"has_child": {"type": "linkedService", "query": QUERY}}}
+        })
+
+    def test_ancestor_filter_uses_has_parent(self):
+        self.assertEqual(plan_model.wrap_join_query("linkedService", "plan", QUERY), {
+            "has_parent": {"parent_type": "linkedPlanService", "query": {"has_parent": {"parent_type": "plan", "query": QUERY}}}
+        })
+
+    def test_sibling_filter_goes_through_the_common_parent(self):
+        self.assertEqual(plan_model.wrap_join_query("linkedService", "planserviceCostShare", QUERY), {
+            "has_parent": {"parent_type": "linkedPlanService", "query": {"has_child": {"type": "planserviceCostShare", "query": QUERY}}}
+        })
+
+class BuildSearchQueryTest(unittest.TestCase):
+    def test_filters_of_the_returned_type(self):
+        self.assertEqual(plan_model.build_search_query("plan", [(None, "planType", "eq", "inNetwork")]), {
+            "bool": {"filter": [
+                {"term": {"join_field": "plan"}},
+                {"bool": {"filter": [{"term": {"planType": "inNetwork"}}]}}
+            ]}
+        })
+
+    def test_range_values_of_integer_fields_are_coerced(self):
+        query = plan_model.build_search_query("plan", [
+            ("planserviceCostShare", "copay", "gte", "10"),
+            ("planserviceCostShare", "copay", "lt", "100")
+        ])
+        self.assertEqual(query["bool"]["filter"][1], {
+            "has_child": {"type": "linkedPlanService", "query": {"has_child": {"type": "planserviceCostShare", "query": {
+                "bool": {"filter": [{"range": {"copay": {"gte": 10}}}, {"range": {"copay": {"lt": 100}}}]}
+            }}}}
+        })
+
+    def test_rejects_invalid_integers(self):
+        with self.assertRaisesRegex(ValueError, "Invalid value for copay"):
+            plan_model.build_search_query("plan", [("planserviceCostShare", "copay", "gt", "ten")])
+
+    def test_rejects_unknown_types(self):
+        with self.assertRaisesRegex(ValueError, "Unknown document type"):
+            plan_model.build_search_query("service", [])
+        with self.assertRaisesRegex(ValueError, "Unknown document type"):
+            plan_model.build_search_query("plan", [("service", "name", "eq", "x")])
+
+    def test_rejects_unknown_fields_and_operators(self):
+        for field in ("price", "join_field", "content_hash"):
+            with self.assertRaisesRegex(ValueError, "Unknown search field"):
+                plan_model.build_search_query("plan", [(None, field, "eq", "x")])
+        with self.assertRaisesRegex(ValueError, "Unknown search operator"):
+            plan_model.build_search_query("plan", [(None, "copay", "ne", "1")])
+
+class BuildSearchAggregationsTest(unittest.TestCase):
+    def test_aggregations(self):
+        self.assertEqual(plan_model.build_search_aggregations(["terms:planType", "stats:deductible", "histogram:copay:50"]), {
+            "terms_planType": {"terms": {"field": "planType"}},
+            "stats_deductible": {"stats": {"field": "deductible"}},
+            "histogram_copay": {"histogram": {"field": "copay", "interval": 50}}
+        })
+
+    def test_rejects_invalid_histograms(self):
+        for aggregation in ("histogram:planType:10", "histogram:copay", "histogram:copay:0", "histogram:copay:-5"):
+            with self.assertRaisesRegex(ValueError, "Invalid histogram aggregation"):
+                plan_model.build_search_aggregations([aggregation])
+
+    def test_rejects_unknown_kinds_and_fields(self):
+        with self.assertRaisesRegex(ValueError, "Unknown aggregation: avg"):
+            plan_model.build_search_aggregations(["avg:copay"])
+        for field in ("price", "content_hash"):
+            with self.assertRaisesRegex(ValueError, "Unknown aggregation field"):
+                plan_model.build_search_aggregations([f"terms:{field}"])
+
+if __name__ == "__main__":
+    unittest.main()
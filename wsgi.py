@@ -0,0 +1,4 @@
+from src import app
+
+# WSGI entry point for production servers: gunicorn -c gunicorn.conf.py wsgi:app
+# The queue consumer is a separate process type: python -m src.consumer